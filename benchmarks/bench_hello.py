@@ -0,0 +1,60 @@
+# coding: utf8
+
+"""
+    hello world吞吐量基准: 直接调用wsgi application, 不经过网络.
+    eager为改造前的行为: 每个请求都构造url_adapter、request并加载session;
+    lazy为按需构造, hello world视图只需要其中用到的部分.
+    用法: python benchmarks/bench_hello.py
+"""
+
+import os
+import sys
+import time
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.contrib.securecookie import SecureCookie
+from werkzeug.test import create_environ
+
+from spoon import Spoon, _request_ctx_stack
+
+
+def make_app(eager):
+    app = Spoon(__name__)
+    app.secret_key = 'bench'
+
+    if eager:
+        @app.before_request
+        def build_everything():
+            ctx = _request_ctx_stack.top
+            ctx.url_adapter, ctx.request, ctx.session
+
+    @app.route('/')
+    def hello_world():
+        return 'Hello, World!'
+
+    return app
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def throughput(app, seconds=2.0):
+    cookie = SecureCookie({'user_id': 1}, 'bench').serialize()
+    environ = create_environ('/', headers=[('Cookie', 'session=' + cookie)])
+    count = 0
+    start = time.time()
+    deadline = start + seconds
+    while time.time() < deadline:
+        for i in xrange(200):
+            ''.join(app(dict(environ), start_response))
+        count += 200
+    return count / (time.time() - start)
+
+
+if __name__ == '__main__':
+    eager = throughput(make_app(True))
+    lazy = throughput(make_app(False))
+    print 'eager context: %8.0f req/s' % eager
+    print 'lazy context:  %8.0f req/s  (%.2fx)' % (lazy, lazy / eager)
@@ -0,0 +1,142 @@
+# coding: utf8
+
+"""
+    Local争用基准: N个线程同时通过LocalProxy读取请求上下文中的属性(相当于视图中的request.x),
+    对比原先每次读写都加全局锁的Local/LocalStack与现在的无锁实现.
+    用法: python benchmarks/bench_local.py
+"""
+
+import os
+import sys
+import threading
+import time
+from thread import allocate_lock
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from sugars.local import Local, LocalStack, LocalProxy, get_ident
+
+
+class LockedLocal(object):
+    """
+        改造前的Local(原样复制, ident函数与现在相同), 每次__getattr__/__setattr__都获取同一把锁
+    """
+    __slots__ = ('__storage__', '__lock__')
+
+    def __init__(self):
+        object.__setattr__(self, '__storage__', {})
+        object.__setattr__(self, '__lock__', allocate_lock())
+
+    def __iter__(self):
+        return self.__storage__.iteritems()
+
+    def __release_local__(self):
+        self.__storage__.pop(get_ident(), None)
+
+    def __setattr__(self, key, value):
+        self.__lock__.acquire()
+        try:
+            ident = get_ident()
+            if ident in self.__storage__:
+                self.__storage__[ident][key] = value
+            else:
+                self.__storage__[ident] = {key: value}
+        finally:
+            self.__lock__.release()
+
+    def __getattr__(self, item):
+        self.__lock__.acquire()
+        try:
+            return self.__storage__[get_ident()][item]
+        except KeyError:
+            raise AttributeError(item)
+        finally:
+            self.__lock__.release()
+
+    def __delattr__(self, item):
+        self.__lock__.acquire()
+        try:
+            del self.__storage__[get_ident()][item]
+        except KeyError:
+            raise AttributeError(item)
+        finally:
+            self.__lock__.release()
+
+
+class LockedLocalStack(object):
+    """
+        改造前的LocalStack(原样复制, 不依赖现在的LocalStack), push/pop额外再获取一把锁,
+        top经过LockedLocal.__getattr__
+    """
+
+    def __init__(self):
+        self._local = LockedLocal()
+        self._lock = allocate_lock()
+
+    def push(self, obj):
+        self._lock.acquire()
+        try:
+            rv = getattr(self._local, 'stack', None)
+            if rv is None:
+                self._local.stack = rv = []
+            rv.append(obj)
+        finally:
+            self._lock.release()
+
+    def pop(self):
+        self._lock.acquire()
+        try:
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                return None
+            if len(stack) == 1:
+                del self._local.stack
+            return stack.pop()
+        finally:
+            self._lock.release()
+
+    @property
+    def top(self):
+        try:
+            return self._local.stack[-1]
+        except (AttributeError, IndexError):
+            return None
+
+
+class Context(object):
+    def __init__(self, value):
+        self.args = {'name': value}
+
+
+def run(stack_class, threads, seconds=1.0):
+    stack = stack_class()
+    args = LocalProxy(lambda: stack.top.args)
+    counts = []
+    stop = []
+
+    def worker(i):
+        stack.push(Context(i))
+        count = 0
+        while not stop:
+            for j in xrange(100):
+                args['name']
+            count += 100
+        stack.pop()
+        counts.append(count)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    time.sleep(seconds)
+    stop.append(True)
+    for t in workers:
+        t.join()
+    return sum(counts) / seconds
+
+
+if __name__ == '__main__':
+    for threads in (1, 2, 4, 8, 16):
+        locked = run(LockedLocalStack, threads)
+        lock_free = run(LocalStack, threads)
+        print '%2d threads: locked %9.0f lookups/s  lock-free %9.0f lookups/s  (%.2fx)' % (
+            threads, locked, lock_free, lock_free / locked)
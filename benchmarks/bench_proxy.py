@@ -0,0 +1,44 @@
+# coding: utf8
+
+"""
+    代理属性访问基准(ns/次): 视图中request.args这样的一次属性访问的开销.
+    lambda proxy为改造前的LocalProxy(lambda: _request_ctx_stack.top.request),
+    bound proxy为现在直接绑定LocalStack的request, current_context为跳过代理直接使用上下文.
+    用法: python benchmarks/bench_proxy.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from sugars.local import LocalProxy
+from spoon import Spoon, request, g, current_context, _request_ctx_stack
+
+app = Spoon(__name__)
+lambda_request = LocalProxy(lambda: _request_ctx_stack.top.request)
+lambda_g = LocalProxy(lambda: _request_ctx_stack.top.g)
+
+
+def bench(name, func, number=200000):
+    func()
+    baseline = min(timeit.repeat(lambda: None, number=number, repeat=3))
+    rv = min(timeit.repeat(func, number=number, repeat=3))
+    print '%-32s %6.0f ns' % (name, (rv - baseline) / number * 1e9)
+
+
+if __name__ == '__main__':
+    with app.test_request_context('/?name=World'):
+        g.db = object()
+        req = request._get_current_object()
+        bench('request.args (lambda proxy)', lambda: lambda_request.args)
+        bench('request.args (bound proxy)', lambda: request.args)
+        bench('current_context().request.args', lambda: current_context().request.args)
+        ctx = current_context()
+        bench('ctx.request.args (ctx held)', lambda: ctx.request.args)
+        bench('request.args (plain object)', lambda: req.args)
+        bench('g.db (lambda proxy)', lambda: lambda_g.db)
+        bench('g.db (bound proxy)', lambda: g.db)
+        bench('current_context().g.db', lambda: current_context().g.db)
+        bench('ctx.g.db (ctx held)', lambda: ctx.g.db)
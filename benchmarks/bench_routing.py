@@ -0,0 +1,51 @@
+# coding: utf8
+
+"""
+    路由匹配基准: 对比url_adapter.match()与Spoon.match_request()在不同路由数量下的耗时,
+    动态路由分别测试关闭/开启url_match_cache.
+    用法: python benchmarks/bench_routing.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from spoon import Spoon, LRUCache, _request_ctx_stack
+
+
+def make_app(count, cache_size=0):
+    app = Spoon(__name__)
+    if cache_size:
+        app.url_match_cache = LRUCache(cache_size)
+    for i in range(count):
+        app.add_url_rule('/page%d' % i, 'page%d' % i)
+        app.add_url_rule('/page%d/<int:item>' % i, 'item%d' % i)
+    app.add_url_rule('/public', 'public')
+    return app
+
+
+def bench(count, number=2000):
+    app = make_app(count)
+    with app.test_request_context('/public'):
+        adapter = _request_ctx_stack.top.url_adapter
+        assert app.match_request() == adapter.match()
+        regex = min(timeit.repeat(adapter.match, number=number, repeat=3))
+        literal = min(timeit.repeat(app.match_request, number=number, repeat=3))
+    print '%5d routes: url_map %8.2f us  literal index %6.2f us' % (
+        count * 2 + 1, regex / number * 1e6, literal / number * 1e6)
+
+    app = make_app(count, cache_size=1024)
+    with app.test_request_context('/page0/42'):
+        adapter = _request_ctx_stack.top.url_adapter
+        assert app.match_request() == adapter.match()
+        regex = min(timeit.repeat(adapter.match, number=number, repeat=3))
+        cached = min(timeit.repeat(app.match_request, number=number, repeat=3))
+    print '%5d routes: dynamic url_map %8.2f us  match cache %6.2f us' % (
+        count * 2 + 1, regex / number * 1e6, cached / number * 1e6)
+
+
+if __name__ == '__main__':
+    for count in (5, 50, 250, 500):
+        bench(count)
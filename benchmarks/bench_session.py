@@ -0,0 +1,79 @@
+# coding: utf8
+
+"""
+    session cookie序列化基准: 对比SecureCookie默认格式(pickle)与JSONSerializer(带/不带压缩)
+    经过Spoon.open_session/save_session的编码、解码耗时和cookie大小.
+    用法: python benchmarks/bench_session.py
+"""
+
+import os
+import sys
+import timeit
+import warnings
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.test import create_environ
+
+from spoon import Spoon, Request, Response
+from sugars.session import JSONSerializer
+
+warnings.simplefilter('ignore')
+
+# minitwit中常见的session: 登录后的user_id, 以及flash()留下的消息
+SESSIONS = [
+    ('logged in', {'user_id': 42}),
+    ('with flash', {'user_id': 42, '_flashes': ['You were logged in']}),
+    ('many flashes', {'user_id': 42, '_flashes': [
+        'You are now following "user%d"' % i for i in range(10)]}),
+]
+
+
+def make_app(serializer):
+    app = Spoon(__name__)
+    app.secret_key = 'development key'
+    app.session_serializer = serializer
+    return app
+
+
+def cookie_value(app, data):
+    session = app.open_session(Request(create_environ()))
+    session.update(data)
+    response = Response()
+    app.save_session(session, response)
+    return response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+
+
+def bench(app, data, number=2000):
+    cookie = cookie_value(app, data)
+    request = Request(create_environ(headers=[('Cookie', 'session=' + cookie)]))
+    request.cookies
+    empty_request = Request(create_environ())
+    empty_request.cookies
+
+    def encode():
+        session = app.open_session(empty_request)
+        session.update(data)
+        app.save_session(session, Response())
+
+    def decode():
+        app.open_session(request).get('user_id')
+
+    assert dict(app.open_session(request)) == data
+    encode_time = min(timeit.repeat(encode, number=number, repeat=3)) / number
+    decode_time = min(timeit.repeat(decode, number=number, repeat=3)) / number
+    return encode_time, decode_time, len(cookie)
+
+
+if __name__ == '__main__':
+    apps = [
+        ('pickle (SecureCookie)', make_app(None)),
+        ('json', make_app(JSONSerializer(compress_threshold=None))),
+        ('json + zlib > 128B', make_app(JSONSerializer(compress_threshold=128))),
+    ]
+    for name, data in SESSIONS:
+        print name
+        for serializer, app in apps:
+            encode_time, decode_time, size = bench(app, data)
+            print '    %-22s encode %6.1f us  decode %6.1f us  cookie %4d bytes' % (
+                serializer, encode_time * 1e6, decode_time * 1e6, size)
@@ -0,0 +1,69 @@
+# coding: utf8
+
+"""
+    静态文件基准: 直接调用wsgi application请求minitwit的/static/style.css, 不经过网络.
+    对比werkzeug的SharedDataMiddleware(每次打开并逐块读取文件)与StaticFiles
+    (小文件缓存在内存中), 以及浏览器带If-None-Match重新验证时的304.
+    用法: python benchmarks/bench_static.py
+"""
+
+import os
+import sys
+import time
+import warnings
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.test import create_environ
+from werkzeug.wsgi import SharedDataMiddleware
+
+from spoon import Spoon
+from sugars.static import StaticFiles
+
+warnings.simplefilter('ignore')
+
+STATIC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                      'examples', 'minitwit', 'static'))
+
+
+def make_app(middleware):
+    app = Spoon(__name__)
+    app.wsgi_app = middleware(app.wsgi_app)
+    return app
+
+
+def throughput(app, headers=(), seconds=2.0):
+    environ = create_environ('/static/style.css', headers=list(headers))
+    state = []
+
+    def start_response(status, headers, exc_info=None):
+        state[:] = [status]
+
+    count = 0
+    start = time.time()
+    deadline = start + seconds
+    while time.time() < deadline:
+        for i in xrange(200):
+            app_iter = app(dict(environ), start_response)
+            ''.join(app_iter)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        count += 200
+    return count / (time.time() - start), state[0]
+
+
+if __name__ == '__main__':
+    apps = [
+        ('SharedDataMiddleware', make_app(
+            lambda app: SharedDataMiddleware(app, {'/static': STATIC}))),
+        ('StaticFiles', make_app(lambda app: StaticFiles(app, '/static', STATIC))),
+    ]
+    for name, app in apps:
+        rate, status = throughput(app)
+        print '%-28s %8.0f req/s  %s' % (name, rate, status)
+        environ = create_environ('/static/style.css')
+        etag = []
+        app(environ, lambda status, headers, exc_info=None: etag.extend(
+            v for k, v in headers if k.lower() == 'etag'))
+        rate, status = throughput(app, [('If-None-Match', etag[0])])
+        print '%-28s %8.0f req/s  %s' % (name + ' (304)', rate, status)
@@ -0,0 +1,107 @@
+# coding: utf8
+
+"""
+    模板基准, 使用minitwit的timeline.html(继承layout.html), 30条消息:
+    cold start: 新建app(相当于新的worker进程)后第一次渲染的耗时,
+                对比不使用字节码缓存与使用已有的字节码缓存(template_bytecode_cache).
+    render rate: 每秒渲染次数, 对比调试模式(每次渲染检查模板文件是否改动)与生产模式.
+    fragment cache: 生产模式下每条消息的片段缓存({% cache %})开启与关闭时的每秒渲染次数.
+    用法: python benchmarks/bench_templates.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+from hashlib import md5
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from jinja2 import FileSystemLoader
+
+from spoon import Spoon, render_template, g
+
+warnings.simplefilter('ignore')
+
+TEMPLATES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                         'examples', 'minitwit', 'templates'))
+
+
+class MiniTwit(Spoon):
+
+    def create_jinja_loader(self):
+        return FileSystemLoader(TEMPLATES)
+
+
+def make_app(bytecode_cache=None, fragment_cache_size=1000):
+    MiniTwit.template_bytecode_cache = bytecode_cache
+    MiniTwit.fragment_cache_size = fragment_cache_size
+    app = MiniTwit(__name__)
+    app.secret_key = 'development key'
+    for endpoint in ('timeline', 'public_timeline', 'logout', 'register',
+                     'login', 'add_message'):
+        app.add_url_rule('/' + endpoint, endpoint)
+    for endpoint in ('user_timeline', 'follow_user', 'unfollow_user'):
+        app.add_url_rule('/<username>/' + endpoint, endpoint)
+    app.jinja_env.filters['datetimeformat'] = lambda ts: time.strftime(
+        '%Y-%m-%d @ %H:%M', time.gmtime(ts))
+    app.jinja_env.filters['gravatar'] = lambda email, size=80: \
+        'http://www.gravatar.com/avatar/%s?d=identicon&s=%d' % (
+            md5(email.strip().lower()).hexdigest(), size)
+    return app
+
+
+MESSAGES = [dict(message_id=i, username='user%d' % i, email='user%d@example.com' % i,
+                 text='message number %d' % i, pub_date=1563000000 + i)
+            for i in range(30)]
+
+
+def render_timeline(app):
+    with app.test_request_context('/'):
+        g.user = dict(user_id=1, username='user1')
+        return render_template('timeline.html', messages=MESSAGES)
+
+
+def render_rate(debug, seconds=2.0, fragment_cache_size=1000):
+    app = make_app(fragment_cache_size=fragment_cache_size)
+    app.debug = debug
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for i in range(20):
+            render_timeline(app)
+        count += 20
+    return count / (time.time() - start), app.template_cache.stats()
+
+
+def cold_start(bytecode_cache=None, runs=20):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        render_timeline(make_app(bytecode_cache))
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    cache_dir = tempfile.mkdtemp()
+    try:
+        render_timeline(make_app(cache_dir))
+        no_cache = cold_start()
+        cached = cold_start(cache_dir)
+        print 'cold start: compile %6.2f ms  bytecode cache %6.2f ms' % (
+            no_cache * 1e3, cached * 1e3)
+    finally:
+        shutil.rmtree(cache_dir)
+
+    debug_rate, debug_stats = render_rate(True)
+    production_rate, production_stats = render_rate(False)
+    print 'render rate: debug %6.0f/s  production %6.0f/s  (%.2fx)' % (
+        debug_rate, production_rate, production_rate / debug_rate)
+    print 'template cache (production): %r' % production_stats
+
+    uncached_rate, stats = render_rate(False, fragment_cache_size=0)
+    print 'fragment cache: off %6.0f/s  on %6.0f/s  (%.2fx)' % (
+        uncached_rate, production_rate, production_rate / uncached_rate)
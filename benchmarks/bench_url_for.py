@@ -0,0 +1,63 @@
+# coding: utf8
+
+"""
+    url_for基准: 对比改造前直接调用url_adapter.build()的url_for与预生成builder/无参数memo的url_for,
+    以及模拟minitwit timeline.html中每条消息调用url_for的30条消息页面.
+    用法: python benchmarks/bench_url_for.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+from spoon import Spoon, url_for, _request_ctx_stack
+
+app = Spoon(__name__)
+app.add_url_rule('/', 'timeline')
+app.add_url_rule('/public', 'public_timeline')
+app.add_url_rule('/<username>', 'user_timeline')
+app.add_url_rule('/<username>/follow', 'follow_user')
+app.add_url_rule('/logout', 'logout')
+
+
+def timeline_page(build):
+    for i in range(30):
+        build('user_timeline', {'username': 'user%d' % i})
+    for endpoint in ('timeline', 'public_timeline', 'logout'):
+        build(endpoint, {})
+    build('static', {'filename': 'style.css'})
+
+
+def main(number=20000):
+    with app.test_request_context('/'):
+        # 改造前的url_for: _request_ctx_stack.top.url_adapter.build(endpoint, values)
+        build = lambda endpoint, values: \
+            _request_ctx_stack.top.url_adapter.build(endpoint, values)
+        cases = [
+            ('no args', lambda: build('public_timeline', {}),
+             lambda: url_for('public_timeline')),
+            ('dynamic', lambda: build('user_timeline', {'username': 'joe'}),
+             lambda: url_for('user_timeline', username='joe')),
+            ('static', lambda: build('static', {'filename': 'style.css'}),
+             lambda: url_for('static', filename='style.css')),
+        ]
+        for name, before, after in cases:
+            assert before() == after()
+            t1 = min(timeit.repeat(before, number=number, repeat=3)) / number
+            t2 = min(timeit.repeat(after, number=number, repeat=3)) / number
+            print '%-10s old url_for %6.2f us  url_for %6.2f us  (%.1fx)' % (
+                name, t1 * 1e6, t2 * 1e6, t1 / t2)
+
+        page_number = number // 100
+        t1 = min(timeit.repeat(lambda: timeline_page(build),
+                               number=page_number, repeat=3)) / page_number
+        t2 = min(timeit.repeat(lambda: timeline_page(lambda e, v: url_for(e, **v)),
+                               number=page_number, repeat=3)) / page_number
+        print '%-10s old url_for %6.2f us  url_for %6.2f us  (%.1fx)' % (
+            '30 msgs', t1 * 1e6, t2 * 1e6, t1 / t2)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,20 +11,29 @@
 
 import os
 import sys
+from collections import deque
+from functools import wraps
 
-from jinja2 import PackageLoader, Environment
-from werkzeug.contrib.securecookie import SecureCookie
-from werkzeug.routing import Map, Rule
+from jinja2 import PackageLoader, Environment, FileSystemBytecodeCache
+from werkzeug.routing import Map, Rule, BuildError
 from werkzeug.test import create_environ
 from werkzeug.wrappers import Request as BaseRequest
 from werkzeug.wrappers import Response as BaseResponse
 from werkzeug.exceptions import HTTPException
-from werkzeug.wsgi import SharedDataMiddleware
+from werkzeug.http import generate_etag, quote_etag, is_resource_modified
+from werkzeug.urls import url_encode
 from werkzeug.utils import redirect
 from werkzeug.exceptions import abort
 from jinja2 import Markup, escape
 
 from sugars.local import LocalStack, LocalProxy
+from sugars.cache import LRUCache
+from sugars.coalesce import SingleFlight
+from sugars.compress import GzipMiddleware
+from sugars.static import StaticFiles
+from sugars.taskpool import TaskPool
+from sugars.session import SecureCookieSession
+from sugars.templating import LazyContext, LazyValue
 
 
 class Request(BaseRequest):
@@ -54,6 +63,24 @@ class _RequestGlobals(object):
     pass
 
 
+class _lazy_attribute(object):
+    """
+        第一次访问时调用func计算, 结果写入实例的__dict__. 它不是数据描述符,
+        之后的访问直接命中实例属性, 不会再经过这里
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
 class _RequestContext(object):
     """
         请求上下文::
@@ -65,18 +92,55 @@ class _RequestContext(object):
 
     def __init__(self, app, environ):
         self.app = app
-        self.url_adapter = app.url_map.bind_to_environ(environ)
-        self.request = app.request_class(environ)
-        self.session = app.open_session(self.request)
+        self.environ = environ
         self.g = _RequestGlobals()
         self.flashes = None
+        # 压栈时所在线程/协程的ident
+        self.ident = None
+        # 调试模式下出错的请求不出栈, 保留给调试器使用
+        self.preserved = False
+
+    # url_adapter, request, session在第一次使用时才构造, 不用的视图函数(如静态页面、健康检查)
+    # 不必为它们付出代价, 尤其是session需要反序列化cookie并校验签名
+    @_lazy_attribute
+    def url_adapter(self):
+        return self.app.url_map.bind_to_environ(self.environ)
+
+    @_lazy_attribute
+    def request(self):
+        return self.app.request_class(self.environ)
+
+    @_lazy_attribute
+    def session(self):
+        return self.app.open_session(self.request)
+
+    @_lazy_attribute
+    def template_context(self):
+        # 所有context processor的结果, 每个请求只计算一次, 多次render_template共用
+        rv = {}
+        for func in self.app.template_context_processors:
+            rv.update(func())
+        return rv
+
+    @property
+    def session_loaded(self):
+        return 'session' in self.__dict__
 
     def __enter__(self):
+        # 同一线程/协程上次保留下来的上下文, 在处理下一个请求前弹出
+        top = _request_ctx_stack.top
+        if top is not None and top.preserved:
+            top.preserved = False
+            _request_ctx_stack.pop()
+        self.ident = _request_ctx_stack.__ident_func__()
         _request_ctx_stack.push(self)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_tb is None or not self.app.debug:
             _request_ctx_stack.pop()
+        else:
+            self.preserved = True
+            self.app._preserve_context(self)
 
 
 def flash(message):
@@ -115,6 +179,93 @@ def render_template(template_name, **context):
     return current_app.jinja_env.get_template(template_name).render(context)
 
 
+def stream_template(template_name, buffer_size=None, **context):
+    """
+        流式渲染模版, 用jinja2的generate()边渲染边发送, 不必先在内存中拼出整个页面,
+        适合很大的页面(如很长的timeline). 渲染发生在响应被server消费时, 这期间会重新
+        压入当前的请求上下文, 模板中照常可以使用request, session, url_for等.
+        注意响应头已经发出, 渲染过程中对session的修改不会再保存; 为此flash消息会在
+        发送响应之前提前取出
+    :param template_name:
+    :param buffer_size: 每次向server写出时合并的片段数, None时使用app.template_stream_buffer_size,
+                        小于等于1时每个片段单独写出
+    :param context:
+    :return: 流式的Response对象
+    """
+    ctx = _request_ctx_stack.top
+    app = ctx.app
+    app.update_template_context(context)
+    if ctx.session:
+        get_flashed_messages()
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    if buffer_size is None:
+        buffer_size = app.template_stream_buffer_size
+    if buffer_size > 1:
+        stream.enable_buffering(buffer_size)
+    return app.response_class(_stream_with_context(ctx, stream))
+
+
+def _stream_with_context(ctx, iterable):
+    """
+        迭代时重新压入请求上下文, 迭代结束(或server提前关闭)时弹出
+    """
+    with ctx:
+        for chunk in iterable:
+            yield chunk
+
+
+def lazy(func):
+    """
+        context processor中返回的延迟求值变量, 模板用到时才调用func, 同一请求中只调用一次;
+        用不到它的页面不必付出代价:
+        @app.context_processor
+        def inject_user():
+            return dict(unread_count=lazy(lambda: count_unread(g.user)))
+    :param func: 无参数的函数
+    :return: LazyValue
+    """
+    return LazyValue(func)
+
+
+def gather(*funcs):
+    """
+        在当前请求中并发执行几个互不依赖的I/O调用(如几次数据库查询、内部http请求), 全部完成后
+        按顺序返回结果, 总耗时约等于最慢的一个. 执行函数的线程都压入当前的请求上下文,
+        函数里照常可以使用request, session, g:
+        user, messages = gather(lambda: load_user(name),
+                                lambda: query_timeline(request.args.get('page')))
+        函数由app.gather_pool的常驻线程和当前线程一起执行, 整个app最多同时占用gather_workers个
+        额外线程, 线程全忙时在当前线程中依次执行; gevent monkey patch之后线程即greenlet.
+        各线程共用同一个上下文, 开始执行前先在当前线程中构造好request, url_adapter和session,
+        并读取请求体(解析表单), 函数中不会重复构造或重复读取wsgi.input.
+        有函数抛出异常时, 等全部结束后抛出排在最前面的那个
+    :param funcs: 无参数的函数
+    :return: 结果列表
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        raise RuntimeError('gather() must be called in a request context')
+    if len(funcs) > 1:
+        ctx.url_adapter
+        ctx.session
+        ctx.request.get_data(parse_form_data=True)
+
+    def bind(func):
+        def call():
+            _request_ctx_stack.push(ctx)
+            try:
+                return func()
+            finally:
+                _request_ctx_stack.pop()
+        return call
+
+    results = ctx.app.gather_pool.run([bind(func) for func in funcs])
+    for ok, value in results:
+        if not ok:
+            raise value[0], value[1], value[2]
+    return [value for ok, value in results]
+
+
 def _default_template_ctx_processor():
     """
         添加额外的context
@@ -123,11 +274,24 @@ def _default_template_ctx_processor():
     reqctx = _request_ctx_stack.top
     return dict(
         request=reqctx.request,
-        session=reqctx.session,
+        # 用代理对象, 模板中用到session时才加载
+        session=session,
         g=reqctx.g
     )
 
 
+def current_context():
+    """
+        获取当前的请求上下文. 热点视图可以先取出上下文, 再直接使用其中的request, session, g,
+        跳过每次属性访问都要经过的LocalProxy:
+        ctx = current_context()
+        name = ctx.request.args['name']
+        ctx.g.db.execute(...)
+    :return: _RequestContext, 不在请求上下文中时为None
+    """
+    return _request_ctx_stack.top
+
+
 def url_for(endpoint, **values):
     """
         根据endpoint和参数构造url, 默认结果是相对路径
@@ -135,10 +299,11 @@ def url_for(endpoint, **values):
     :param values:
     :return:
     """
-    return _request_ctx_stack.top.url_adapter.build(endpoint, values)
+    ctx = _request_ctx_stack.top
+    return ctx.app.build_url(ctx.url_adapter, endpoint, values)
 
 
-class Spoon:
+class Spoon(object):
     # 请求类，默认为Request，可更改
     request_class = Request
 
@@ -147,27 +312,119 @@ class Spoon:
 
     jinja_options = dict(
         autoescape=True,
-        extensions=['jinja2.ext.autoescape', 'jinja2.ext.with_']
+        extensions=['jinja2.ext.autoescape', 'jinja2.ext.with_',
+                    'sugars.templating.FragmentCacheExtension']
     )
 
     static_path = '/static'
 
+    # 静态文件的Cache-Control: max-age(秒)
+    static_max_age = 43200
+
+    # 静态文件内存缓存的总字节数上限(0表示不缓存), 只缓存不超过static_cache_file_size字节的文件
+    static_cache_size = 8 * 1024 * 1024
+    static_cache_file_size = 256 * 1024
+
+    # 启动时为static目录中的文件生成带内容hash的文件名, url_for('static', filename='style.css')
+    # 返回/static/style.<hash>.css, 这样的url以一年的immutable Cache-Control发送
+    static_fingerprint = False
+
+    # 客户端接受gzip时压缩不小于compress_min_size字节的文本响应,
+    # 静态文件改为发送预先压缩好的.gz文件(第一次请求时在static目录中生成)
+    compress_responses = True
+    compress_min_size = 500
+    compress_level = 6
+
+    # 模板字节码缓存目录(相对root_path), 设置后编译结果保存到文件, 新的worker进程不必重新编译模板.
+    # None表示不使用
+    template_bytecode_cache = None
+
+    # 内存中保存的已编译模板数量上限. 非调试模式下模板不再自动重新加载,
+    # 命中缓存时也就不会每次渲染都检查模板文件是否改动
+    template_cache_size = 400
+
+    # 模板片段缓存({% cache key, ttl %})的条目数上限, 0表示不缓存
+    fragment_cache_size = 1000
+
+    # 片段缓存key的前缀, 如版本号. 部署新版本或需要整体失效时修改它,
+    # 运行中修改则设置app.jinja_env.fragment_cache_prefix
+    fragment_cache_prefix = ''
+
+    # @app.cached响应缓存的条目数上限, 0表示不缓存
+    response_cache_size = 500
+
+    # route(..., coalesce=True)的路由等待合并请求结果的默认超时(秒), 超时后自己调用视图函数
+    coalesce_timeout = 10
+
+    # gather()可以使用的工作线程数(整个app共用), 0表示gather中的函数全部依次执行
+    gather_workers = 8
+
+    # stream_template每次写出时合并的片段数
+    template_stream_buffer_size = 5
+
     secret_key = None
 
     session_cookie_name = 'session'
 
+    # 保存在cookie中的session的序列化方式, 如sugars.session.JSONSerializer;
+    # None时沿用SecureCookie的格式(pickle)
+    session_serializer = None
+
+    # 服务端session存储, 如sugars.session.MemorySessionStore, SqliteSessionStore.
+    # 设置后cookie中只保存session id, 不再需要secret_key
+    session_store = None
+
+    # 动态路由匹配结果的LRU缓存大小, 0表示不缓存
+    url_match_cache_size = 0
+
+    # 调试模式下最多保留多少个出错请求的上下文, 超出时释放最早的
+    preserved_context_limit = 16
+
     def __init__(self, package_name):
         self.package_name = package_name
         self.root_path = _get_package_path(self.package_name)
         self.url_map = Map()  # 路由Map
+        # 不含转换器的静态路由索引: path -> [(methods, endpoint, defaults), ...]
+        # 值为None表示该path需交回url_map匹配
+        self.literal_routes = {}
+        # 动态路由匹配缓存: (host, method, path) -> (endpoint, values)
+        self.url_match_cache = None
+        if self.url_match_cache_size:
+            self.url_match_cache = LRUCache(self.url_match_cache_size)
+        # 注册Rule时预先生成的url构造函数: endpoint -> [builder, ...], 值为None表示交回url_adapter.build
+        self.url_builders = {}
+        # 无参数url_for的结果: (endpoint, method, script_name) -> url
+        self.url_build_memo = {}
+        # 托管静态文件的StaticFiles, 其manifest供url_for('static', ...)使用
+        self.static_files = None
         self.view_funcs = {}
+        # 开启了请求合并的endpoint: endpoint -> 等待超时
+        self.coalesced_endpoints = {}
+        self.single_flight = SingleFlight()
+        # gather()的工作线程, 第一次使用时才启动
+        self.gather_pool = TaskPool(self.gather_workers)
+        # run(server='pool')启动的ThreadPoolWSGIServer, 用于查看stats()
+        self.server = None
         self.before_request_funcs = []
         self.after_request_funcs = []
         self.error_handlers = {}
-        self.debug = False
+        self._debug = False
+        self.preserved_contexts = deque()
+        # 保存了session的响应数, 和session未改动而跳过序列化的响应数
+        self.session_save_stats = dict(saved=0, skipped=0)
         self.template_context_processors = [_default_template_ctx_processor]
         self.jinja_env = Environment(loader=self.create_jinja_loader(),
+                                     bytecode_cache=self.create_bytecode_cache(),
+                                     auto_reload=self.debug,
                                      **self.jinja_options)
+        # 模板读取变量时展开lazy()的值
+        self.jinja_env.context_class = LazyContext
+        # 用LRUCache代替jinja2自带的缓存, 可以通过template_cache.stats()查看命中情况
+        self.template_cache = self.jinja_env.cache = LRUCache(self.template_cache_size)
+        self.fragment_cache = self.jinja_env.fragment_cache = self.create_fragment_cache()
+        self.jinja_env.fragment_cache_prefix = self.fragment_cache_prefix
+        # @app.cached缓存的响应: key -> (status, headers, body, etag)
+        self.response_cache = self.create_response_cache()
         self.jinja_env.globals.update(
             url_for=url_for,
             get_flashed_messages=get_flashed_messages,
@@ -175,15 +432,33 @@ class Spoon:
 
         if self.static_path is not None:
             """
-                用werkzeug中的SharedDataMiddleware托管静态文件
+                用sugars.static中的StaticFiles托管静态文件
             """
-            self.url_map.add(Rule(self.static_path + '/<filename>',
-                                  build_only=True, endpoint='static'))
+            self.add_url_rule(self.static_path + '/<filename>', 'static',
+                              build_only=True, methods=None)
             target = os.path.join(self.root_path, 'static')
 
-            self.wsgi_app = SharedDataMiddleware(self.wsgi_app, {
-                self.static_path: target
-            })
+            self.wsgi_app = self.static_files = StaticFiles(
+                self.wsgi_app, self.static_path, target,
+                max_age=self.static_max_age, cache_size=self.static_cache_size,
+                cache_file_size=self.static_cache_file_size,
+                precompress_size=self.compress_min_size if self.compress_responses else None,
+                fingerprint=self.static_fingerprint)
+        if self.compress_responses:
+            self.wsgi_app = GzipMiddleware(self.wsgi_app, self.compress_min_size,
+                                           self.compress_level)
+
+    @property
+    def debug(self):
+        return self._debug
+
+    @debug.setter
+    def debug(self, value):
+        """
+            调试模式下模板文件改动后自动重新加载; 非调试模式(生产模式)下不检查
+        """
+        self._debug = value
+        self.jinja_env.auto_reload = value
 
     def before_request(self, func):
         """
@@ -210,35 +485,136 @@ class Spoon:
                 return rv
 
     def process_response(self, response):
-        session = _request_ctx_stack.top.session
-        if session is not None:
+        ctx = _request_ctx_stack.top
+        # 没用过或没改动的session不序列化, 也不发送Set-Cookie
+        session = ctx.session if ctx.session_loaded else None
+        if session is not None and session.should_save:
             self.save_session(session, response)
+            self.session_save_stats['saved'] += 1
+        elif self.secret_key is not None or self.session_store is not None:
+            self.session_save_stats['skipped'] += 1
         for handler in self.after_request_funcs:
             response = handler(response)
         return response
 
     def open_session(self, request):
+        store = self.session_store
+        if store is not None:
+            sid = request.cookies.get(self.session_cookie_name)
+            if sid is None or not store.is_valid_key(sid):
+                return store.new()
+            return store.get(sid)
         key = self.secret_key
-        if key is not None:
-            return SecureCookie.load_cookie(request, self.session_cookie_name,
-                                            secret_key=key)
+        if key is None:
+            return None
+        serializer = self.session_serializer
+        if serializer is None:
+            return SecureCookieSession.load_cookie(request, self.session_cookie_name,
+                                                   secret_key=key)
+        data = request.cookies.get(self.session_cookie_name)
+        data = serializer.loads(data, key) if data else None
+        if data is None:
+            return SecureCookieSession(secret_key=key)
+        return SecureCookieSession(data, key, False)
 
     def save_session(self, session, response):
-        if session is not None:
-            session.save_cookie(response, self.session_cookie_name)
+        if session is None:
+            return
+        store = self.session_store
+        if store is None:
+            serializer = self.session_serializer
+            if serializer is None:
+                session.save_cookie(response, self.session_cookie_name)
+            elif session.should_save:
+                response.set_cookie(self.session_cookie_name,
+                                    serializer.dumps(dict(session), session.secret_key),
+                                    httponly=True)
+            return
+        # 只在session被修改时写入存储, 清空的session从存储中删除
+        if not session.should_save:
+            return
+        if session:
+            store.save(session)
+            if session.new:
+                response.set_cookie(self.session_cookie_name, session.sid,
+                                    httponly=True)
+        elif not session.new:
+            store.delete(session)
+            response.delete_cookie(self.session_cookie_name)
 
     def create_jinja_loader(self):
         return PackageLoader(self.package_name)
 
+    def create_bytecode_cache(self):
+        """
+            根据template_bytecode_cache创建jinja2的文件字节码缓存
+        :return: FileSystemBytecodeCache 或 None
+        """
+        if self.template_bytecode_cache is None:
+            return None
+        directory = os.path.join(self.root_path, self.template_bytecode_cache)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return FileSystemBytecodeCache(directory)
+
+    def create_fragment_cache(self):
+        """
+            创建模板片段缓存, 默认为进程内的LRUCache. 可以重写这个方法换成其他存储,
+            只要提供get(key)和set(key, value, ttl)
+        :return: 缓存对象 或 None(不缓存)
+        """
+        if not self.fragment_cache_size:
+            return None
+        return LRUCache(self.fragment_cache_size)
+
+    def create_response_cache(self):
+        """
+            创建@app.cached使用的响应缓存, 默认为进程内的LRUCache. 可以重写这个方法换成其他存储,
+            只要提供get(key)和set(key, value, ttl), 保存的值可以pickle
+        :return: 缓存对象 或 None(不缓存)
+        """
+        if not self.response_cache_size:
+            return None
+        return LRUCache(self.response_cache_size)
+
+    def precompile_templates(self, extensions=('html', 'htm', 'xml', 'txt')):
+        """
+            启动时预先加载包中的所有模板, 编译结果进入jinja_env的缓存(以及字节码缓存),
+            处理第一批请求时不必再编译. 模板有语法错误时在这里就会抛出
+        :param extensions: 只加载这些扩展名的文件, None表示全部
+        :return: 加载的模板名列表
+        """
+        names = self.jinja_env.list_templates(extensions=extensions)
+        for name in names:
+            self.jinja_env.get_template(name)
+        return names
+
     def context_processor(self, func):
         """
-            添加模板变量的函数
+            添加模板变量的函数, 每个请求只调用一次. 计算代价大的变量可以用lazy()包装,
+            模板用到时才求值
         :param func:
         :return:
         """
         self.template_context_processors.append(func)
         return func
 
+    def _preserve_context(self, ctx):
+        """
+            记录调试模式下保留的上下文. 处理请求的线程/协程结束后不会再来弹出它,
+            超过preserved_context_limit时释放最早的, 避免Local中的条目无限增长
+        :param ctx: 保留的请求上下文
+        :return:
+        """
+        preserved = self.preserved_contexts
+        preserved.append(ctx)
+        while len(preserved) > self.preserved_context_limit:
+            old = preserved.popleft()
+            # 只有它还独自留在栈上时才释放, 已被弹出或压在其他上下文下面的不动
+            if old.preserved and _request_ctx_stack.stack_of(old.ident) == [old]:
+                old.preserved = False
+                _request_ctx_stack.release(old.ident)
+
     def request_context(self, environ):
         return _RequestContext(self, environ)
 
@@ -247,12 +623,79 @@ class Spoon:
 
     def update_template_context(self, context):
         """
-            更新jinja2上下文
+            更新jinja2上下文, context processor的结果在同一请求中缓存
         :param context:
         :return:
         """
-        for func in self.template_context_processors:
-            context.update(func())
+        context.update(_request_ctx_stack.top.template_context)
+
+    def cached(self, ttl=None, vary=(), session_key=None):
+        """
+            缓存整个响应的装饰器, 放在route下面:
+            @app.route('/public')
+            @app.cached(ttl=60)
+            def public_timeline():
+                ...
+            只缓存GET/HEAD请求的200响应, 缓存的key包括host, path和query string.
+            响应自动带上ETag, 请求的If-None-Match匹配时返回304. 命中缓存时不调用视图函数,
+            before_request, after_request和session的处理照常进行.
+            视图(或before_request)读取过session时只有指定了session_key才缓存, 修改了session
+            (如get_flashed_messages取出flash消息)的响应不缓存
+        :param ttl: 过期时间(秒), None表示不过期(只会被LRU淘汰)
+        :param vary: 会影响响应内容的请求头, 如['Accept-Language'], 加入key和Vary响应头
+        :param session_key: 响应因用户而不同时, 把session中的这个值(如'user_id')加入key
+        :return:
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(**values):
+                cache = self.response_cache
+                ctx = _request_ctx_stack.top
+                request = ctx.request
+                if cache is None or request.method not in ('GET', 'HEAD'):
+                    return func(**values)
+                key = self._response_cache_key(ctx, vary, session_key)
+                rv = cache.get(key)
+                if rv is None:
+                    response = self.make_response(func(**values))
+                    # 出错、流式和设置了cookie的响应不缓存
+                    if response.status_code != 200 or response.is_streamed or \
+                            'Set-Cookie' in response.headers:
+                        return response
+                    # session的cookie要到process_response才写入, 这里直接检查session:
+                    # 读取过session(又没有用session_key区分)或修改过session的响应因人而异, 不缓存
+                    session = ctx.session if ctx.session_loaded else None
+                    if session is not None and (session_key is None or session.should_save):
+                        return response
+                    body = response.get_data()
+                    etag = response.headers.get('ETag')
+                    if etag is None:
+                        etag = quote_etag(generate_etag(body))
+                        response.headers['ETag'] = etag
+                    if vary or session_key is not None:
+                        response.headers['Vary'] = ', '.join(
+                            list(vary) + (['Cookie'] if session_key is not None else []))
+                    rv = (response.status_code, response.headers.to_wsgi_list(), body, etag)
+                    cache.set(key, rv, ttl)
+                status, headers, body, etag = rv
+                if not is_resource_modified(ctx.environ, etag=etag):
+                    return self.response_class(status=304, headers=[('ETag', etag)])
+                return self.response_class(body, status, headers)
+
+            return wrapper
+
+        return decorator
+
+    def _response_cache_key(self, ctx, vary, session_key):
+        request = ctx.request
+        parts = [request.host, request.path, url_encode(request.args, sort=True)]
+        for header in vary:
+            parts.append(request.headers.get(header, ''))
+        if session_key is not None:
+            session = ctx.session
+            parts.append(repr(session.get(session_key)) if session is not None else '')
+        return u'\n'.join(parts)
 
     def errorhandler(self, code):
         """
@@ -279,7 +722,7 @@ class Spoon:
             return self.response_class(rv)
         if isinstance(rv, tuple):
             return self.response_class(*rv)
-        return self.response_class.force_type(rv, _request_ctx_stack.top.request.environ)
+        return self.response_class.force_type(rv, _request_ctx_stack.top.environ)
 
     def dispatch_request(self):
         """
@@ -287,7 +730,9 @@ class Spoon:
         :return: 路由处理函数的返回结果 或 抛出异常
         """
         try:
-            endpoint, values = _request_ctx_stack.top.url_adapter.match()
+            endpoint, values = self.match_request()
+            if endpoint in self.coalesced_endpoints:
+                return self._dispatch_coalesced(endpoint, values)
             return self.view_funcs[endpoint](**values)
         except HTTPException, e:
             handler = self.error_handlers.get(e.code)
@@ -300,6 +745,42 @@ class Spoon:
                 raise
             return handler(e)
 
+    def _dispatch_coalesced(self, endpoint, values):
+        """
+            同时到达的相同GET/HEAD请求(host, path, query string都相同)只调用一次视图函数,
+            其余请求共享它的响应. 流式响应、设置了cookie的响应和读取过session的响应(因人而异,
+            如带有g.user或flash消息的页面)不共享, 等待的请求自己调用视图函数
+        :return: 视图函数的返回结果 或 共享的Response对象
+        """
+        view = self.view_funcs[endpoint]
+        ctx = _request_ctx_stack.top
+        if ctx.request.method not in ('GET', 'HEAD'):
+            return view(**values)
+
+        called = []
+
+        def call():
+            called.append(True)
+            response = self.make_response(view(**values))
+            if response.is_streamed or 'Set-Cookie' in response.headers:
+                return response, None
+            # 与cached()相同, session的cookie要到process_response才写入, 这里直接检查session
+            if ctx.session_loaded and ctx.session is not None:
+                return response, None
+            return response, (response.get_data(), response.status,
+                              response.headers.to_wsgi_list())
+
+        key = (endpoint, self._response_cache_key(ctx, (), None))
+        response, shared = self.single_flight.do(key, call,
+                                                 self.coalesced_endpoints[endpoint])
+        if called:
+            return response
+        # 其他请求的结果, 每个请求用自己的Response对象
+        if shared is None:
+            return view(**values)
+        body, status, headers = shared
+        return self.response_class(body, status, headers)
+
     def wsgi_app(self, environ, start_response):
         """
             真正的wsgi application， 路由转发, 构造Response对象，
@@ -321,12 +802,186 @@ class Spoon:
             添加路由
         :param rule: 路由规则
         :param endpoint: 处理函数对应的key
-        :param options: 其他参数, 构造Rule时用到, 如methods=['POST', 'PUT']
+        :param options: 其他参数, 构造Rule时用到, 如methods=['POST', 'PUT'];
+                        coalesce=True或超时秒数: 开启请求合并, 同时到达的相同GET请求只调用一次视图函数,
+                        只适用于响应不因用户而不同的路由(读取过session的响应不会共享)
         :return:
         """
+        coalesce = options.pop('coalesce', False)
+        if coalesce:
+            self.coalesced_endpoints[endpoint] = \
+                self.coalesce_timeout if coalesce is True else coalesce
         options['endpoint'] = endpoint
         options.setdefault('methods', ('GET',))
-        self.url_map.add(Rule(rule, **options))
+        url_rule = Rule(rule, **options)
+        self.url_map.add(url_rule)
+        self._index_literal_rule(url_rule)
+        self._add_url_builder(url_rule)
+        self.url_build_memo.clear()
+        if self.url_match_cache is not None:
+            self.url_match_cache.clear()
+
+    def _index_literal_rule(self, rule):
+        """
+            把不含转换器的路由登记到literal_routes中, 匹配时直接查字典, 不必对url_map逐条跑正则.
+            会触发重定向(结尾斜杠、alias、redirect_to、defaults)等特殊行为的path登记为None,
+            匹配时交回url_map处理, 保证结果与url_map完全一致.
+        :param rule: 已加入url_map的Rule
+        :return:
+        """
+        if rule.defaults and self.url_map.redirect_defaults:
+            # 后加入的带defaults的Rule同样会让url_map对同一endpoint已登记的路由重定向
+            for r in self.url_map.iter_rules(rule.endpoint):
+                if r is not rule and not r.build_only and not r.arguments and \
+                        rule.provides_defaults_for(r):
+                    for path, defer in self._literal_paths(r, True):
+                        if path:
+                            self.literal_routes[path] = None
+        if rule.build_only or rule.arguments:
+            return
+        special = rule.alias or rule.redirect_to is not None or \
+            rule.subdomain or self.url_map.host_matching
+        if not special and self.url_map.redirect_defaults:
+            special = any(r is not rule and r.provides_defaults_for(rule)
+                          for r in self.url_map.iter_rules(rule.endpoint))
+
+        entry = (rule.methods, rule.endpoint, rule.defaults or {})
+        for path, defer in self._literal_paths(rule, special):
+            if not path:
+                continue
+            if defer:
+                self.literal_routes[path] = None
+            elif self.literal_routes.get(path, ()) is not None:
+                self.literal_routes.setdefault(path, []).append(entry)
+
+    def _literal_paths(self, rule, special):
+        """
+            不含转换器的Rule能匹配的path, 以及是否需要交回url_map处理
+        :return: [(path, defer), ...]
+        """
+        # 与url_map相同: 非叶子路由(/foo/)也能匹配/foo, 叶子路由在非strict_slashes时也能匹配/foo/
+        paths = [(rule.rule, special)]
+        if not rule.is_leaf:
+            paths.append((rule.rule.rstrip('/'), special or rule.strict_slashes))
+        elif not rule.strict_slashes:
+            paths.append((rule.rule + '/', special))
+        return paths
+
+    def _add_url_builder(self, rule):
+        """
+            为Rule预先生成builder(values, method) -> path, 不适用时返回None.
+            suitable_for的检查提前算好, 不含转换器的路由直接返回常量path;
+            跨子域名/host的路由不生成builder, 交回url_adapter.build处理
+        :param rule: 已加入url_map的Rule
+        :return:
+        """
+        if rule.subdomain or self.url_map.host_matching:
+            self.url_builders[rule.endpoint] = None
+            return
+        builders = self.url_builders.setdefault(rule.endpoint, [])
+        if builders is None:
+            return
+
+        methods = rule.methods
+        defaults = (rule.defaults or {}).items()
+        required = frozenset(rule.arguments).difference(rule.defaults or ())
+        build = rule.build
+        constant = None
+        if not rule.arguments:
+            constant = build({})[1]
+
+        def builder(values, method):
+            if method is not None and methods is not None and method not in methods:
+                return None
+            if not values and constant is not None:
+                return constant
+            if not required.issubset(values):
+                return None
+            for key, value in defaults:
+                if key in values and value != values[key]:
+                    return None
+            rv = build(values)
+            if rv is not None:
+                return rv[1]
+
+        # 与url_map相同, 同一endpoint的Rule按build_compare_key排序(稳定排序)
+        builder.compare_key = rule.build_compare_key()
+        builders.append(builder)
+        builders.sort(key=lambda b: b.compare_key)
+
+    def build_url(self, adapter, endpoint, values):
+        """
+            url_for的实现, 结果与adapter.build(endpoint, values)完全一致.
+            有预生成builder的endpoint(结果是相对路径), 无参数的构造结果缓存在url_build_memo中,
+            add_url_rule时清空.
+            static_fingerprint开启时, static的filename换成manifest中带hash的文件名
+        :param adapter: 当前请求的url_adapter
+        :param endpoint:
+        :param values: url参数, 多余的参数作为query string
+        :return: 相对路径的url
+        """
+        if values:
+            if endpoint == 'static' and self.static_files is not None and \
+                    self.static_files.manifest:
+                filename = self.static_files.manifest.get(values.get('filename'))
+                if filename is not None:
+                    values = dict(values, filename=filename)
+            return self._build_url(adapter, endpoint, values)
+        if self.url_builders.get(endpoint) is None:
+            # 交给adapter.build的(如跨子域名的)路由可能返回依赖scheme, host的绝对url, 不缓存
+            return self._build_url(adapter, endpoint, {})
+        key = (endpoint, adapter.default_method, adapter.script_name)
+        rv = self.url_build_memo.get(key)
+        if rv is None:
+            rv = self.url_build_memo[key] = self._build_url(adapter, endpoint, {})
+        return rv
+
+    def _build_url(self, adapter, endpoint, values):
+        builders = self.url_builders.get(endpoint)
+        if builders is not None:
+            for value in values.itervalues():
+                if value is None:
+                    values = dict(i for i in values.iteritems() if i[1] is not None)
+                    break
+            # 与MapAdapter.build相同: 先找适用于当前请求方法的Rule, 再忽略方法找一遍
+            for method in (adapter.default_method, None):
+                for builder in builders:
+                    path = builder(values, method)
+                    if path is not None:
+                        return '%s/%s' % (adapter.script_name.rstrip('/'), path.lstrip('/'))
+        # 没有预生成的builder, 或没有适用的Rule(由url_adapter抛出BuildError)
+        return adapter.build(endpoint, values)
+
+    def match_request(self):
+        """
+            匹配当前请求的路由, 静态路由直接查literal_routes, 动态路由先查url_match_cache,
+            其余(未缓存的动态路由、404、405、重定向)交给url_adapter.match()
+        :return: (endpoint, values) 或 抛出HTTPException
+        """
+        ctx = _request_ctx_stack.top
+        environ = ctx.environ
+        # 直接使用environ, 命中时不必构造url_adapter
+        path_info = environ.get('PATH_INFO')
+        method = environ.get('REQUEST_METHOD', 'GET').upper()
+        if path_info:
+            rules = self.literal_routes.get('/' + path_info.lstrip('/'))
+            if rules is not None:
+                for methods, endpoint, defaults in rules:
+                    if methods is None or method in methods:
+                        return endpoint, dict(defaults)
+
+        cache = self.url_match_cache
+        if cache is None:
+            return ctx.url_adapter.match()
+        key = (environ.get('HTTP_HOST') or environ.get('SERVER_NAME'),
+               method, path_info)
+        rv = cache.get(key)
+        if rv is None:
+            # 只缓存成功的匹配, 404/405/重定向等异常每次都交给url_map
+            rv = ctx.url_adapter.match()
+            cache.set(key, rv)
+        endpoint, values = rv
+        return endpoint, dict(values)
 
     def route(self, rule, **options):
         """
@@ -349,20 +1004,47 @@ class Spoon:
 
     def run(self, host='localhost', port=5000, **options):
         """
-            启动wekzeug中的简单server, 可用于调试
+            启动server, 默认为wekzeug中的简单server, 可用于调试
         :param host: 主机地址, 设置为0.0.0.0可开放访问
         :param port: 端口
-        :param options:
+        :param options: debug: 调试模式;
+                        server: 'gevent'时用gevent的WSGIServer, 每个连接一个greenlet;
+                                'prefork'时fork出多个worker进程共享监听socket(workers=进程数,
+                                默认为cpu核数), 适合生产环境;
+                                'pool'时用固定大小的线程池(workers=线程数, queue_size=排队上限),
+                                排队已满时返回503和Retry-After(retry_after=秒数),
+                                运行中可以用app.server.stats()查看排队时间和利用率;
+                        其余参数传给对应的server
         :return:
         """
-        from werkzeug.serving import run_simple
         if 'debug' in options:
             self.debug = options.pop('debug')
+        server = options.pop('server', None)
+        if server == 'gevent':
+            from sugars.serving import run_gevent as serve
+        elif server == 'prefork':
+            from sugars.serving import run_prefork as serve
+        elif server == 'pool':
+            from sugars.serving import make_pool_server
+        elif server is not None:
+            raise ValueError('unknown server %r' % server)
+        if server is not None:
+            app = self
+            if self.debug:
+                from werkzeug.debug import DebuggedApplication
+                app = DebuggedApplication(self, evalex=True)
+            if server == 'pool':
+                self.server = make_pool_server(host, port, app, **options)
+                return self.server.serve_forever()
+            return serve(host, port, app, **options)
+
+        from werkzeug.serving import run_simple
         use_reloader = use_debugger = self.debug
         run_simple(host, port,
                    self,
                    use_reloader=use_reloader,
-                   use_debugger=use_debugger)
+                   use_debugger=use_debugger,
+                   **options)
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
@@ -371,7 +1053,8 @@ class Spoon:
 # 请求上下文栈
 _request_ctx_stack = LocalStack()
 # 请求上下文的request LocalProxy，可动态获取当前上下文的request
-request = LocalProxy(lambda: _request_ctx_stack.top.request)
-current_app = LocalProxy(lambda: _request_ctx_stack.top.app)
-session = LocalProxy(lambda: _request_ctx_stack.top.session)
-g = LocalProxy(lambda: _request_ctx_stack.top.g)
+# 直接绑定栈顶上下文的属性, 比LocalProxy(lambda: _request_ctx_stack.top.request)少几层调用
+request = LocalProxy(_request_ctx_stack, 'request')
+current_app = LocalProxy(_request_ctx_stack, 'app')
+session = LocalProxy(_request_ctx_stack, 'session')
+g = LocalProxy(_request_ctx_stack, 'g')
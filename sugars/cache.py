@@ -0,0 +1,105 @@
+# coding: utf-8
+
+from collections import OrderedDict
+from thread import allocate_lock
+from time import time
+
+
+class LRUCache(object):
+    """
+        线程安全的LRU缓存, 超过maxsize时淘汰最久未使用的条目, 并统计命中/未命中次数:
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.get('a')  # 1
+        cache.stats()   # {'hits': 1, 'misses': 0, 'size': 1, 'maxsize': 2}
+        set时可以指定ttl(秒), 过期的条目在下次get时删除并计为未命中.
+        指定sizeof时maxsize限制的是所有值的sizeof之和(如字节数), 而不是条目数
+    """
+
+    def __init__(self, maxsize=128, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        # 所有条目的sizeof之和, 未指定sizeof时为条目数
+        self.size = 0
+        # key -> (value, 过期时间), 过期时间为None表示不过期
+        self._data = OrderedDict()
+        self._lock = allocate_lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                item = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            expires = item[1]
+            if expires is not None and expires <= time():
+                self.size -= self._sizeof(item[0])
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = time() + ttl
+        self._lock.acquire()
+        try:
+            self._pop(key)
+            self._data[key] = (value, expires)
+            self.size += self._sizeof(value)
+            while self.size > self.maxsize and self._data:
+                self.size -= self._sizeof(self._data.popitem(last=False)[1][0])
+        finally:
+            self._lock.release()
+
+    # 兼容dict的写法, 如用作jinja2 Environment的cache
+    __setitem__ = set
+
+    def _sizeof(self, value):
+        if self.sizeof is None:
+            return 1
+        return self.sizeof(value)
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= self._sizeof(item[0])
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._pop(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=self.size, maxsize=self.maxsize)
+
+    @property
+    def capacity(self):
+        # jinja2的copy_cache(如Environment.overlay)用capacity构造新的缓存
+        return self.maxsize
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and (item[1] is None or item[1] > time())
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+"""
+    sugars.coalesce::
+    请求合并(single flight). 同一个key同时只执行一次, 并发的其他调用等待它的结果:
+
+    flight = SingleFlight()
+    rv = flight.do(('timeline', page), lambda: query_timeline(page), timeout=5)
+
+    等待超时, 或第一个调用抛出异常时, 等待者各自再执行一次, 不会因为合并而多出失败.
+    等待使用threading.Event, 在gevent下需要先monkey patch.
+"""
+
+from thread import allocate_lock
+from threading import Event
+
+
+class _Call(object):
+    __slots__ = ('event', 'value', 'ok')
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.ok = False
+
+
+class SingleFlight(object):
+    """
+        合并同一个key上的并发调用, 并统计执行、共享结果和等待失败后自行执行的次数
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.fallbacks = 0
+        # key -> 正在执行的_Call
+        self._calls = {}
+        self._lock = allocate_lock()
+
+    def do(self, key, func, timeout=None):
+        """
+            执行func(), 同一个key已经有调用在执行时等待并共享它的结果
+        :param key: 可hash的key
+        :param func: 无参数的函数
+        :param timeout: 最多等待的秒数, None表示一直等待
+        :return: func()的结果
+        """
+        self._lock.acquire()
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call()
+            self.calls += 1
+            self._lock.release()
+            try:
+                call.value = func()
+                call.ok = True
+                return call.value
+            finally:
+                self._lock.acquire()
+                del self._calls[key]
+                self._lock.release()
+                call.event.set()
+        self._lock.release()
+
+        if call.event.wait(timeout) and call.ok:
+            self._count('shared')
+            return call.value
+        self._count('fallbacks')
+        return func()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return dict(calls=self.calls, shared=self.shared, fallbacks=self.fallbacks,
+                    in_flight=len(self._calls))
@@ -0,0 +1,169 @@
+# coding: utf-8
+
+"""
+    sugars.compress::
+    gzip压缩中间件. 客户端的Accept-Encoding接受gzip时, 文本类(mimetypes)且不小于minimum_size字节
+    的响应压缩后发送, 没有Content-Length的流式响应逐块压缩, 每块立即flush, 不影响流式输出.
+    静态文件由sugars.static.StaticFiles发送预先压缩好的.gz文件(gzip_file生成), 不经过这里压缩.
+
+    app.wsgi_app = GzipMiddleware(app.wsgi_app, minimum_size=500)
+"""
+
+import os
+import zlib
+from tempfile import mkstemp
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+    'text/javascript', 'application/javascript', 'application/x-javascript',
+    'application/json', 'application/xml', 'application/rss+xml',
+    'application/atom+xml', 'image/svg+xml',
+])
+
+
+def accepts_gzip(environ):
+    """
+        客户端是否接受gzip编码(q=0表示不接受)
+    """
+    return parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING')).quality('gzip') > 0
+
+
+def _gzip_compressor(level):
+    # wbits为16 + MAX_WBITS时输出gzip格式(带gzip头和尾)
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_file(filename, level=9):
+    """
+        生成filename.gz, 先写入临时文件再改名, 其他请求不会读到写了一半的文件
+    :param filename: 源文件
+    :param level: 压缩级别, 只压缩一次, 默认用最高级别
+    :return: .gz文件名
+    """
+    target = filename + '.gz'
+    fd, tmp = mkstemp(dir=os.path.dirname(filename), prefix='.gzip-')
+    try:
+        compressor = _gzip_compressor(level)
+        with os.fdopen(fd, 'wb') as out:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(65536), ''):
+                    out.write(compressor.compress(block))
+            out.write(compressor.flush())
+        os.rename(tmp, target)
+    except:
+        os.unlink(tmp)
+        raise
+    return target
+
+
+class GzipMiddleware(object):
+    """
+        压缩响应的wsgi中间件, 错误响应、已经编码过的响应和带Cache-Control: no-transform的响应不压缩.
+        压缩后的ETag改为弱ETag. HEAD请求按同样的条件改写响应头(Content-Encoding, Vary, ETag),
+        与对应的GET一致
+    """
+
+    def __init__(self, app, minimum_size=500, compress_level=6,
+                 mimetypes=COMPRESSIBLE_MIMETYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compress_level = compress_level
+        self.mimetypes = mimetypes
+
+    def __call__(self, environ, start_response):
+        if not accepts_gzip(environ):
+            return self.app(environ, start_response)
+        return self._compress(environ, start_response)
+
+    def _compress(self, environ, start_response):
+        captured = []
+        written = []
+
+        def _start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = self.app(environ, _start_response)
+        if not captured:
+            # 生成器形式的application在第一次迭代时才调用start_response
+            app_iter = _prefetch(app_iter)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+        if written:
+            app_iter = ClosingIterator(written + list(app_iter), getattr(app_iter, 'close', None))
+        if not self._should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers['Content-Encoding'] = 'gzip'
+        headers.add('Vary', 'Accept-Encoding')
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            # 压缩后内容不同, 只能作为弱ETag, 条件请求中弱比较仍然匹配
+            headers['ETag'] = 'W/' + etag
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            # 与GET的响应头相同, 但没有内容可压缩, 压缩后的长度未知, 不发送Content-Length
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            del headers['Content-Length']
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return []
+        if 'Content-Length' in headers:
+            try:
+                body = ''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            compressor = _gzip_compressor(self.compress_level)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return ClosingIterator(self._stream(app_iter), getattr(app_iter, 'close', None))
+
+    def _should_compress(self, status, headers):
+        if not status.startswith('200') or 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        if mimetype not in self.mimetypes:
+            return False
+        length = headers.get('Content-Length')
+        return length is None or int(length) >= self.minimum_size
+
+    def _stream(self, app_iter):
+        compressor = _gzip_compressor(self.compress_level)
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            yield data + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class _prefetch(object):
+    """
+        先取出第一块数据, 让生成器形式的application调用start_response
+    """
+
+    def __init__(self, app_iter):
+        self._app_iter = app_iter
+        self._iter = iter(app_iter)
+        self._first = []
+        for chunk in self._iter:
+            self._first.append(chunk)
+            break
+
+    def __iter__(self):
+        for chunk in self._first:
+            yield chunk
+        for chunk in self._iter:
+            yield chunk
+
+    def close(self):
+        if hasattr(self._app_iter, 'close'):
+            self._app_iter.close()
@@ -8,100 +8,140 @@ try:
 except:
     get_current_greenlet = int
 
-from thread import get_ident as get_current_thread, allocate_lock
+from thread import get_ident as get_current_thread
 
 if get_current_greenlet is int:
     get_ident = get_current_thread
 else:
-    get_ident = lambda: (get_current_thread(), get_current_thread())
+    # 每个线程都有自己的主greenlet, 以当前greenlet作为ident, 线程和协程就都能区分开.
+    # 用greenlet对象本身而不是id(), 避免greenlet结束后id被复用; 条目在栈弹空时释放
+    get_ident = get_current_greenlet
 
 
 class Local(object):
     """
         类似ThreadLocal的实现, 可以应付协程场景。
+        每个线程/协程(ident)只读写自己的那一份dict, 而对__storage__的单次get/set/pop在GIL下
+        是原子的, 所以读写都不需要加锁, 多线程下也不会争抢同一个互斥锁。
     """
-    __slots__ = ('__storage__', '__lock__')
+    __slots__ = ('__storage__', '__ident_func__')
 
     def __init__(self):
         object.__setattr__(self, '__storage__', {})
-        object.__setattr__(self, '__lock__', allocate_lock())
+        object.__setattr__(self, '__ident_func__', get_ident)
 
     def __iter__(self):
-        return self.__storage__.iteritems()
+        # 其他线程可能同时增删条目, 遍历快照
+        return iter(self.__storage__.items())
 
     def __release_local__(self):
-        self.__storage__.pop(get_ident(), None)
+        self.__storage__.pop(self.__ident_func__(), None)
 
     def __setattr__(self, key, value):
-        self.__lock__.acquire()
+        ident = self.__ident_func__()
+        storage = self.__storage__
         try:
-            ident = get_ident()
-            if ident in self.__storage__:
-                self.__storage__[ident][key] = value
-            else:
-                self.__storage__[ident] = {key: value}
-        finally:
-            self.__lock__.release()
+            storage[ident][key] = value
+        except KeyError:
+            storage[ident] = {key: value}
 
     def __getattr__(self, item):
-        self.__lock__.acquire()
         try:
-            return self.__storage__[get_ident()][item]
+            return self.__storage__[self.__ident_func__()][item]
         except KeyError:
             raise AttributeError(item)
-        finally:
-            self.__lock__.release()
 
     def __delattr__(self, item):
-        self.__lock__.acquire()
         try:
-            del self.__storage__[get_ident()][item]
+            del self.__storage__[self.__ident_func__()][item]
         except KeyError:
             raise AttributeError(item)
-        finally:
-            self.__lock__.release()
 
 
 class LocalStack(object):
     """
         Local封装, 可以用使用Stack的方式压入弹出变量
         可优雅处理请求上下文
+        栈只会被所属的线程/协程修改, 同样不需要加锁
+        栈弹空时释放该ident在Local中的条目, 否则每个处理过请求的线程/协程都会留下一条记录
     """
 
     def __init__(self):
         self._local = Local()
-        self._lock = allocate_lock()
+
+    @property
+    def __ident_func__(self):
+        return self._local.__ident_func__
 
     def push(self, obj):
-        self._lock.acquire()
-        try:
-            rv = getattr(self._local, 'stack', None)
-            if rv is None:
-                self._local.stack = rv = []
-            rv.append(obj)
-        finally:
-            self._lock.release()
+        rv = getattr(self._local, 'stack', None)
+        if rv is None:
+            self._local.stack = rv = []
+        rv.append(obj)
 
     def pop(self):
-        self._lock.acquire()
-        try:
-            stack = getattr(self._local, 'stack', None)
-            if stack is None:
-                return None
-            if len(stack) == 1:
-                del self._local.stack
-            return stack.pop()
-        finally:
-            self._lock.release()
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            return None
+        if len(stack) == 1:
+            self._local.__release_local__()
+        return stack.pop()
+
+    def release(self, ident):
+        """
+            丢弃指定ident的整个栈, 用于清理不会再被弹出的栈(如已经结束的线程留下的)
+        :param ident: __ident_func__()的返回值
+        :return:
+        """
+        self._local.__storage__.pop(ident, None)
+
+    def stack_of(self, ident):
+        """
+            获取指定ident的栈(不存在时为空列表), 只用于检查, 不要修改
+        :param ident:
+        :return:
+        """
+        return self._local.__storage__.get(ident, {}).get('stack', [])
 
     @property
     def top(self):
+        # 直接查__storage__, 不经过Local.__getattr__
+        local = self._local
         try:
-            return self._local.stack[-1]
-        except(AttributeError, IndexError):
+            return local.__storage__[local.__ident_func__()]['stack'][-1]
+        except (KeyError, IndexError):
             return None
 
 
+def _make_resolver(local, name):
+    """
+        为LocalProxy生成获取当前对象的函数, 创建代理时就确定好查找方式, 每次访问不必再判断类型
+    :param local: Local, LocalStack, 或者返回当前对象的函数
+    :param name: Local或LocalStack栈顶对象上的属性名
+    :return:
+    """
+    if isinstance(local, Local):
+        def resolve():
+            try:
+                return getattr(local, name)
+            except AttributeError:
+                raise RuntimeError('no object bound to %s' % name)
+        return resolve
+
+    if isinstance(local, LocalStack) and name is not None:
+        _local = local._local
+        storage = _local.__storage__
+
+        def resolve():
+            try:
+                return getattr(storage[_local.__ident_func__()]['stack'][-1], name)
+            except (KeyError, IndexError):
+                raise RuntimeError('no object bound to %s' % name)
+        return resolve
+
+    return local
+
+
 class LocalProxy(object):
     """
         代理Local中特定对象， 如：
@@ -117,20 +157,20 @@ class LocalProxy(object):
         _request_ctx_stack.push(_RequestContext())
         request = LocalProxy(lambda: _request_ctx_stack.top.request)
         每次使用request时，都会动态获得当前上下文的request :)
+
+        传入LocalStack和name时直接绑定栈顶对象的属性, 如:
+        request = LocalProxy(_request_ctx_stack, 'request')
+        省掉lambda和LocalStack.top、Local.__getattr__这几层调用, 适合request, session这类热点对象
     """
-    __slots__ = ('__local__', '__dict__', '__name__')
+    __slots__ = ('__local__', '__dict__', '__name__', '__resolve__')
 
     def __init__(self, local, name=None):
         object.__setattr__(self, '__local__', local)
         object.__setattr__(self, '__name__', name)
+        object.__setattr__(self, '__resolve__', _make_resolver(local, name))
 
     def _get_current_object(self):
-        if not isinstance(self.__local__, Local):
-            return self.__local__()
-        try:
-            return getattr(self.__local__, self.__name__)
-        except AttributeError:
-            raise RuntimeError('no object bound to %s' % self.__name__)
+        return self.__resolve__()
 
     @property
     def __dict__(self):
@@ -159,7 +199,7 @@ class LocalProxy(object):
             return repr(self)
 
     def __getattr__(self, item):
-        return getattr(self._get_current_object(), item)
+        return getattr(self.__resolve__(), item)
 
     def __dir__(self):
         try:
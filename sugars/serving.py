@@ -0,0 +1,314 @@
+# coding: utf-8
+
+"""
+    sugars.serving::
+    Spoon.run可选的server实现: gevent, prefork(多进程), pool(固定大小线程池).
+    Spoon基于Python 2, 没有asyncio/ASGI; 单进程高并发的场景由gevent承担,
+    请求上下文按greenlet隔离(见sugars.local).
+"""
+
+import errno
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from Queue import Queue
+
+from werkzeug.serving import BaseWSGIServer
+
+
+def make_gevent_server(host, port, app, **options):
+    """
+        构造gevent的WSGIServer, 每个连接由一个greenlet处理, 一个进程可以同时挂住成千上万个
+        慢速的I/O连接. 视图中的阻塞I/O(socket, sqlite之外的网络调用等)需要在程序最开始执行
+        gevent.monkey.patch_all()才会让出.
+    :param host:
+    :param port:
+    :param app: wsgi application
+    :param options: 传给WSGIServer, 如backlog, spawn(整数或gevent.pool.Pool, 限制同时处理的请求数)
+    :return: WSGIServer
+    """
+    from gevent.pywsgi import WSGIServer
+    return WSGIServer((host, port), app, **options)
+
+
+def run_gevent(host, port, app, **options):
+    make_gevent_server(host, port, app, **options).serve_forever()
+
+
+class PreforkServer(object):
+    """
+        多进程prefork server, 只依赖标准库(和werkzeug的WSGI server).
+        master进程监听端口后fork出workers个worker进程, 它们共享同一个监听socket,
+        由内核把连接分给各个worker. app在fork之前已经导入并初始化好, worker与master
+        以copy-on-write的方式共享这部分内存. worker意外退出时master重新fork一个;
+        master收到SIGTERM(或SIGINT)时通知所有worker处理完手上的请求后退出,
+        超过graceful_timeout仍未退出的worker被强制结束.
+    """
+
+    # worker处理请求之间检查是否需要退出的间隔(秒)
+    poll_interval = 0.5
+
+    def __init__(self, host, port, app, workers=None, threaded=False, backlog=128,
+                 graceful_timeout=30):
+        """
+        :param host:
+        :param port: 0表示由系统分配, 可通过server_port得到
+        :param app: wsgi application
+        :param workers: worker进程数, 默认为cpu核数
+        :param threaded: worker是否每个请求一个线程
+        :param backlog: 监听socket的连接队列长度
+        :param graceful_timeout: 退出时等待worker处理完请求的秒数
+        """
+        self.host = host
+        self.app = app
+        self.workers = workers or multiprocessing.cpu_count()
+        self.threaded = threaded
+        self.graceful_timeout = graceful_timeout
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        # 多个worker同时被唤醒时只有一个能accept到连接, 其余的立即返回, 不会阻塞在accept上
+        self.socket.setblocking(0)
+        self.server_port = self.socket.getsockname()[1]
+        # pid -> fork时间
+        self.children = {}
+        self.stopping = False
+        # worker进程中为True, 收到SIGTERM后置为False
+        self.alive = True
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        try:
+            for i in range(self.workers):
+                self.spawn_worker()
+            while not self.stopping:
+                self._reap(block=True)
+                while not self.stopping and len(self.children) < self.workers:
+                    self.spawn_worker()
+        finally:
+            self._stop_workers()
+            self.socket.close()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        status = 0
+        try:
+            self._run_worker()
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        signal.signal(signal.SIGTERM, self._handle_worker_stop)
+        # Ctrl-C由master统一处理, 再通过SIGTERM通知worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        from werkzeug.serving import make_server
+        server = make_server(self.host, self.server_port, self.app, threaded=self.threaded,
+                             fd=self.socket.fileno())
+        # python2中socket.fromfd返回的是不带makefile的底层socket, 换回共享的socket对象
+        server.socket.close()
+        server.socket = self.socket
+        server.timeout = self.poll_interval
+        while self.alive:
+            server.handle_request()
+        # threaded时等待处理中的请求线程结束
+        current = threading.current_thread()
+        for thread in threading.enumerate():
+            if thread is not current and not isinstance(thread, threading._MainThread):
+                thread.join(self.graceful_timeout)
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _handle_worker_stop(self, signum, frame):
+        self.alive = False
+
+    def _reap(self, block=False):
+        """
+            回收已退出的worker
+        :param block: 是否等待到有worker退出(或收到信号)
+        """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    return
+                if e.errno == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if not pid:
+                return
+            started = self.children.pop(pid, None)
+            if not self.stopping and started is not None and time.time() - started < 1:
+                # 刚启动就退出(如导入错误), 稍等再重新fork, 避免不停地fork
+                time.sleep(1)
+            block = False
+
+    def _stop_workers(self):
+        for pid in self.children:
+            _kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for pid in self.children:
+            _kill(pid, signal.SIGKILL)
+        while self.children:
+            self._reap(block=True)
+
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def run_prefork(host, port, app, **options):
+    PreforkServer(host, port, app, **options).serve_forever()
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """
+        固定大小线程池的WSGI server. 接受的连接放入长度为queue_size的队列, 由workers个线程处理;
+        队列已满时立即返回503和Retry-After并关闭连接, 过载时不会无限制地创建线程、堆积内存.
+        stats()返回排队时间和线程池利用率等指标
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, workers=16, queue_size=None, retry_after=1,
+                 reject_body='Service Unavailable', **options):
+        """
+        :param workers: 处理请求的线程数
+        :param queue_size: 等待处理的连接数上限, 默认为workers的2倍; 0表示线程全忙时立即拒绝
+        :param retry_after: 拒绝时Retry-After的秒数
+        :param reject_body: 拒绝时的响应内容
+        :param options: 传给werkzeug的BaseWSGIServer, 如handler, passthrough_errors, ssl_context
+        """
+        BaseWSGIServer.__init__(self, host, port, app, **options)
+        self.workers = workers
+        self.queue_size = workers * 2 if queue_size is None else queue_size
+        self.retry_after = retry_after
+        self.reject_body = reject_body
+        self.requests = Queue()
+        self.busy = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='spoon-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        # 按已接受但未处理完的连接数判断, 不受线程取出队列的时机影响
+        with self._lock:
+            full = self.accepted - self.completed >= self.workers + self.queue_size
+            if not full:
+                self.accepted += 1
+        if full:
+            self._reject(request)
+        else:
+            self.requests.put((request, client_address, time.time()))
+
+    def _work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address, queued_at = item
+            wait = time.time() - queued_at
+            with self._lock:
+                self.busy += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._lock:
+                    self.busy -= 1
+                    self.completed += 1
+
+    def _reject(self, request):
+        body = self.reject_body
+        response = ('HTTP/1.1 503 Service Unavailable\r\n'
+                    'Retry-After: %d\r\n'
+                    'Content-Type: text/plain; charset=utf-8\r\n'
+                    'Content-Length: %d\r\n'
+                    'Connection: close\r\n\r\n%s') % (self.retry_after, len(body), body)
+        try:
+            # 先读掉已经到达的请求, 避免关闭时内核因为有未读数据而发送RST, 客户端收不到503
+            request.setblocking(0)
+            try:
+                request.recv(65536)
+            except socket.error:
+                pass
+            request.setblocking(1)
+            request.sendall(response)
+        except socket.error:
+            pass
+        finally:
+            self.shutdown_request(request)
+        with self._lock:
+            self.rejected += 1
+
+    def server_close(self):
+        # 处理完队列中已接受的连接后结束线程
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        BaseWSGIServer.server_close(self)
+
+    def stats(self):
+        """
+        :return: workers: 线程数, busy: 正在处理请求的线程数, utilization: busy / workers,
+                 queued: 排队中的连接数, accepted/rejected/completed: 累计的连接数,
+                 wait_avg/wait_max: 连接排队等待的平均/最长秒数
+        """
+        with self._lock:
+            started = self.completed + self.busy
+            return dict(workers=self.workers, busy=self.busy,
+                        utilization=float(self.busy) / self.workers,
+                        queued=self.requests.qsize(), queue_size=self.queue_size,
+                        accepted=self.accepted, rejected=self.rejected,
+                        completed=self.completed,
+                        wait_avg=self.wait_total / started if started else 0.0,
+                        wait_max=self.wait_max)
+
+
+def make_pool_server(host, port, app, **options):
+    """
+        构造固定大小线程池的WSGI server, 需要在运行中查看stats()时用它代替run_pool
+        (app.run(server='pool')启动的server保存在app.server中)
+    :param options: 见ThreadPoolWSGIServer, 如workers, queue_size, retry_after
+    :return: ThreadPoolWSGIServer
+    """
+    return ThreadPoolWSGIServer(host, port, app, **options)
+
+
+def run_pool(host, port, app, **options):
+    make_pool_server(host, port, app, **options).serve_forever()
@@ -0,0 +1,290 @@
+# coding: utf-8
+
+"""
+    sugars.session::
+    服务端session存储. cookie中只保存session id, session的内容保存在服务端,
+    不必每次响应都把整个session序列化、签名后塞进cookie. 用法:
+
+    app.session_store = MemorySessionStore(maxsize=10000)
+    # 或
+    app.session_store = SqliteSessionStore('/path/to/sessions.db')
+
+    session只在内容真正改变时标记为modified, 没有改动的session不会被序列化和保存.
+
+    保存在cookie中的session默认沿用SecureCookie的格式(每个值单独pickle), 也可以换成
+    更紧凑、不执行pickle的JSONSerializer:
+    app.session_serializer = JSONSerializer(compress_threshold=256)
+"""
+
+import hmac
+import json
+import sqlite3
+import zlib
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from calendar import timegm
+from contextlib import closing
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from datetime import datetime
+from hashlib import sha1
+from time import time
+
+from werkzeug.contrib.securecookie import SecureCookie
+from werkzeug.contrib.sessions import Session, SessionStore
+from werkzeug.security import safe_str_cmp
+
+from sugars.cache import LRUCache
+
+
+class ChangeTrackingMixin(object):
+    """
+        werkzeug的ModificationTrackingDict只要调用了pop, setdefault, clear等方法就标记为modified,
+        即使内容没有任何变化, 如get_flashed_messages中的session.pop('_flashes', []).
+        这里只在内容确实会改变时才交给父类处理(并标记modified)
+    """
+    __slots__ = ()
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        return super(ChangeTrackingMixin, self).pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        return super(ChangeTrackingMixin, self).setdefault(key, default)
+
+    def clear(self):
+        if self:
+            super(ChangeTrackingMixin, self).clear()
+
+    def update(self, *args, **kwargs):
+        if args or kwargs:
+            super(ChangeTrackingMixin, self).update(*args, **kwargs)
+
+
+class SecureCookieSession(ChangeTrackingMixin, SecureCookie):
+    """
+        保存在签名cookie中的session
+    """
+
+
+class ServerSession(ChangeTrackingMixin, Session):
+    """
+        保存在服务端存储中的session, cookie中只有sid
+    """
+    __slots__ = ()
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class JSONSerializer(object):
+    """
+        紧凑安全的session cookie格式. 整个session编码为一段JSON, 只能还原出基本类型,
+        不会像pickle那样在反序列化时执行代码; tuple和datetime用带标签的对象表示.
+        编码后超过compress_threshold字节时用zlib压缩(压缩后更小才采用), 最后用HMAC签名:
+        <payload>.<mac>, 压缩过的payload以'.'开头
+    """
+
+    def __init__(self, compress_threshold=256, hash_method=sha1):
+        self.compress_threshold = compress_threshold
+        self.hash_method = hash_method
+
+    def _tag(self, value):
+        if isinstance(value, tuple):
+            return {' t': [self._tag(x) for x in value]}
+        if isinstance(value, list):
+            return [self._tag(x) for x in value]
+        if isinstance(value, dict):
+            return dict((k, self._tag(v)) for k, v in value.iteritems())
+        if isinstance(value, datetime):
+            return {' d': timegm(value.utctimetuple())}
+        return value
+
+    def _untag(self, obj):
+        if len(obj) == 1:
+            key, value = obj.items()[0]
+            if key == ' t':
+                return tuple(value)
+            if key == ' d':
+                return datetime.utcfromtimestamp(value)
+        return obj
+
+    def _sign(self, payload, secret_key):
+        if secret_key is None:
+            raise RuntimeError('no secret key defined')
+        if isinstance(secret_key, unicode):
+            secret_key = secret_key.encode('utf-8')
+        return _b64encode(hmac.new(secret_key, payload, self.hash_method).digest())
+
+    def dumps(self, data, secret_key):
+        """
+            序列化并签名session
+        :param data: session中的数据
+        :param secret_key: 签名用的密钥
+        :return: cookie的值
+        """
+        raw = json.dumps(self._tag(data), separators=(',', ':'))
+        payload = _b64encode(raw)
+        if self.compress_threshold is not None and len(raw) > self.compress_threshold:
+            compressed = '.' + _b64encode(zlib.compress(raw))
+            if len(compressed) < len(payload):
+                payload = compressed
+        return '%s.%s' % (payload, self._sign(payload, secret_key))
+
+    def loads(self, string, secret_key):
+        """
+            校验签名并反序列化session
+        :param string: cookie的值
+        :param secret_key: 签名用的密钥
+        :return: session中的数据, 签名不符或格式错误时返回None
+        """
+        if isinstance(string, unicode):
+            string = string.encode('utf-8', 'replace')
+        payload, sep, mac = string.rpartition('.')
+        if not sep or not safe_str_cmp(mac, self._sign(payload, secret_key)):
+            return None
+        try:
+            if payload.startswith('.'):
+                raw = zlib.decompress(_b64decode(payload[1:]))
+            else:
+                raw = _b64decode(payload)
+            data = json.loads(raw, object_hook=self._untag)
+        except (TypeError, ValueError, zlib.error):
+            return None
+        if not isinstance(data, dict):
+            return None
+        return data
+
+
+class MemorySessionStore(SessionStore):
+    """
+        进程内的LRU存储, 超过maxsize时淘汰最久未使用的session.
+        只适合单进程部署, 多个进程之间互不共享
+    """
+
+    def __init__(self, maxsize=10000, session_class=ServerSession):
+        SessionStore.__init__(self, session_class)
+        self.cache = LRUCache(maxsize)
+
+    def save(self, session):
+        # 保存序列化后的数据, 不同请求拿到的session互不影响
+        self.cache.set(session.sid, dumps(dict(session), HIGHEST_PROTOCOL))
+
+    def delete(self, session):
+        self.cache.delete(session.sid)
+
+    def get(self, sid):
+        data = self.cache.get(sid)
+        if data is None:
+            # 不接受客户端指定的未知sid, 重新生成, 避免session fixation
+            return self.new()
+        return self.session_class(loads(data), sid, False)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+        保存在sqlite文件中的session, 进程重启后依然有效, 同一台机器上的多个进程可以共享.
+        cache_size大于0时在前面加一层进程内LRU缓存, 读取命中时不访问数据库;
+        多个进程共享同一个文件时, 其他进程的修改不会使本进程的缓存失效, 此时应设为0.
+        每行记录最后一次保存的时间, 超过max_age秒没有保存过的session视为不存在,
+        save()每隔purge_interval秒顺便删除一次过期的行(也可以在定时任务中调用purge())
+    """
+
+    def __init__(self, path, cache_size=1000, session_class=ServerSession,
+                 max_age=30 * 24 * 3600, purge_interval=3600):
+        """
+        :param path: sqlite文件路径
+        :param cache_size: 进程内缓存的session数, 0表示不缓存
+        :param session_class: session类
+        :param max_age: session自最后一次保存起的有效期(秒), None表示永不过期
+        :param purge_interval: save()中清理过期行的间隔(秒), None表示不自动清理
+        """
+        SessionStore.__init__(self, session_class)
+        self.path = path
+        self.max_age = max_age
+        self.purge_interval = purge_interval
+        self.last_purge = time()
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+        with closing(self._connect()) as db:
+            db.execute('create table if not exists spoon_sessions '
+                       '(sid text primary key, data blob not null, '
+                       'updated real not null default 0)')
+            columns = [row[1] for row in db.execute('pragma table_info(spoon_sessions)')]
+            if 'updated' not in columns:
+                # 没有updated列的旧文件: 已有的session从现在开始计算有效期
+                db.execute('alter table spoon_sessions '
+                           'add column updated real not null default 0')
+                db.execute('update spoon_sessions set updated = ?', (time(),))
+            db.execute('create index if not exists spoon_sessions_updated '
+                       'on spoon_sessions (updated)')
+            db.commit()
+
+    def _connect(self):
+        # sqlite连接不能跨线程使用, 每次操作单独打开
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _cutoff(self):
+        # 早于这个时间保存的session已经过期
+        if self.max_age is None:
+            return 0
+        return time() - self.max_age
+
+    def save(self, session):
+        data = dumps(dict(session), HIGHEST_PROTOCOL)
+        now = time()
+        with closing(self._connect()) as db:
+            db.execute('insert or replace into spoon_sessions (sid, data, updated) '
+                       'values (?, ?, ?)', (session.sid, sqlite3.Binary(data), now))
+            db.commit()
+        if self.cache is not None:
+            self.cache.set(session.sid, data, self.max_age)
+        if self.purge_interval is not None and now - self.last_purge >= self.purge_interval:
+            self.last_purge = now
+            self.purge()
+
+    def purge(self):
+        """
+            删除过期的session
+        :return: 删除的行数
+        """
+        if self.max_age is None:
+            return 0
+        with closing(self._connect()) as db:
+            count = db.execute('delete from spoon_sessions where updated < ?',
+                               (self._cutoff(),)).rowcount
+            db.commit()
+        return count
+
+    def delete(self, session):
+        with closing(self._connect()) as db:
+            db.execute('delete from spoon_sessions where sid = ?', (session.sid,))
+            db.commit()
+        if self.cache is not None:
+            self.cache.delete(session.sid)
+
+    def get(self, sid):
+        data = None
+        if self.cache is not None:
+            data = self.cache.get(sid)
+        if data is None:
+            with closing(self._connect()) as db:
+                row = db.execute('select data, updated from spoon_sessions '
+                                 'where sid = ? and updated >= ?',
+                                 (sid, self._cutoff())).fetchone()
+            if row is None:
+                return self.new()
+            data = str(row[0])
+            if self.cache is not None:
+                ttl = None
+                if self.max_age is not None:
+                    ttl = row[1] + self.max_age - time()
+                self.cache.set(sid, data, ttl)
+        return self.session_class(loads(data), sid, False)
@@ -0,0 +1,278 @@
+# coding: utf-8
+
+"""
+    sugars.static::
+    静态文件服务, 代替werkzeug的SharedDataMiddleware:
+    - 不超过cache_file_size字节的小文件连同响应头一起缓存在内存中, 总大小不超过cache_size字节,
+      命中时只需一次os.stat确认文件没有改动;
+    - 大文件交给server的wsgi.file_wrapper(可以用sendfile)发送;
+    - 支持单个区间的Range请求(206/416)和If-Range;
+    - 强ETag和Last-Modified, 条件请求匹配时返回304;
+    - 指定precompress_size时, 客户端接受gzip的文本文件改为发送旁边的.gz文件,
+      .gz文件在第一次请求时生成(源文件改动后重新生成), 之后每次请求都不必再压缩;
+    - fingerprint为True时启动时计算每个文件的内容hash, 生成manifest: style.css -> style.<hash>.css,
+      带hash的url内容永远不变, 以一年的immutable Cache-Control发送.
+
+    app.wsgi_app = StaticFiles(app.wsgi_app, '/static', '/path/to/static')
+"""
+
+import os
+from hashlib import md5
+from mimetypes import guess_type
+from zlib import adler32
+
+from werkzeug.http import http_date, is_resource_modified, parse_range_header
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+
+from sugars.cache import LRUCache
+from sugars.compress import COMPRESSIBLE_MIMETYPES, accepts_gzip, gzip_file
+
+# 带hash的url对应的内容不会改变, 允许缓存一年且不必重新验证
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class _StaticFile(object):
+    """
+        一个静态文件的元信息, 以及缓存在内存中的内容(大文件为None)
+    """
+    __slots__ = ('filename', 'mimetype', 'mtime', 'size', 'etag', 'last_modified',
+                 'headers', 'data')
+
+    def __init__(self, filename, st, mimetype, data=None):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        self.etag = '"%x-%x-%x"' % (int(st.st_mtime * 1e6), st.st_size,
+                                    adler32(filename) & 0xffffffff)
+        self.last_modified = http_date(st.st_mtime)
+        content_type = mimetype
+        if mimetype.startswith('text/') or mimetype == 'application/javascript':
+            content_type += '; charset=utf-8'
+        self.headers = [
+            ('Content-Type', content_type),
+            ('ETag', self.etag),
+            ('Last-Modified', self.last_modified),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        self.data = data
+
+
+class StaticFiles(object):
+    """
+        托管url_path下的静态文件的wsgi中间件, 其他请求(以及找不到的文件)交给app处理
+    """
+
+    # 每次读出并交给server的块大小
+    buffer_size = 64 * 1024
+
+    def __init__(self, app, url_path, directory, max_age=43200,
+                 cache_size=8 * 1024 * 1024, cache_file_size=256 * 1024,
+                 fallback_mimetype='text/plain', precompress_size=None,
+                 mimetypes=COMPRESSIBLE_MIMETYPES, fingerprint=False):
+        """
+        :param app: 下一层wsgi application
+        :param url_path: url前缀, 如'/static'
+        :param directory: 静态文件所在目录
+        :param max_age: Cache-Control的max-age(秒), None时不发送Cache-Control
+        :param cache_size: 内存缓存的总字节数上限, 0表示不缓存
+        :param cache_file_size: 只缓存不超过这个字节数的文件
+        :param fallback_mimetype: 无法根据文件名判断类型时使用的mimetype
+        :param precompress_size: 不小于这个字节数的文本文件发送gzip压缩版本, None表示不压缩
+        :param mimetypes: 需要压缩的mimetype
+        :param fingerprint: 是否生成带内容hash的文件名(manifest)
+        """
+        self.app = app
+        self.url_prefix = url_path.rstrip('/') + '/'
+        self.directory = directory
+        self.cache_control = None
+        if max_age is not None:
+            self.cache_control = 'public, max-age=%d' % max_age
+        self.cache_file_size = cache_file_size
+        self.fallback_mimetype = fallback_mimetype
+        self.precompress_size = precompress_size
+        self.mimetypes = mimetypes
+        # 相对路径 -> _StaticFile
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(cache_size, sizeof=lambda f: f.size)
+        # 文件名 -> 带hash的文件名, 以及反向的映射
+        self.manifest = None
+        self.fingerprints = {}
+        if fingerprint:
+            self.build_manifest()
+
+    def build_manifest(self):
+        """
+            计算目录下每个文件的内容hash, 生成manifest. 部署后文件有改动时需要重新调用
+        :return: manifest, 如{'style.css': 'style.1a2b3c4d5e.css'}
+        """
+        manifest = {}
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in files:
+                # 跳过隐藏文件和生成的.gz文件
+                if filename.startswith('.') or filename.endswith('.gz'):
+                    continue
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as f:
+                    digest = md5(f.read()).hexdigest()[:10]
+                name = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                base, ext = os.path.splitext(name)
+                manifest[name] = '%s.%s%s' % (base, digest, ext)
+        self.fingerprints = dict((v, k) for k, v in manifest.iteritems())
+        self.manifest = manifest
+        return manifest
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        method = environ.get('REQUEST_METHOD')
+        if not path.startswith(self.url_prefix) or method not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+        name = path[len(self.url_prefix):]
+        cache_control = self.cache_control
+        if self.fingerprints:
+            real_name = self.fingerprints.get(name)
+            if real_name is not None:
+                name = real_name
+                cache_control = IMMUTABLE_CACHE_CONTROL
+        static_file = self.lookup(name)
+        if static_file is None:
+            return self.app(environ, start_response)
+        headers = []
+        if cache_control is not None:
+            headers.append(('Cache-Control', cache_control))
+        if self.precompress_size is not None and static_file.size >= self.precompress_size \
+                and static_file.mimetype in self.mimetypes:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_gzip(environ):
+                gzipped = self.lookup_gzipped(name, static_file)
+                if gzipped is not None:
+                    static_file = gzipped
+                    headers.append(('Content-Encoding', 'gzip'))
+        return self.serve(static_file, environ, start_response, headers)
+
+    def lookup(self, name):
+        """
+            查找静态文件, 内存缓存中的文件改动(mtime或大小变化)后重新读取
+        :param name: url_prefix之后的相对路径
+        :return: _StaticFile 或 None(不存在)
+        """
+        cache = self.cache
+        if cache is not None:
+            static_file = cache.get(name)
+            if static_file is not None:
+                try:
+                    st = os.stat(static_file.filename)
+                except OSError:
+                    cache.delete(name)
+                    return None
+                if st.st_mtime == static_file.mtime and st.st_size == static_file.size:
+                    return static_file
+
+        filename = safe_join(self.directory, name)
+        if filename is None:
+            return None
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if not os.path.isfile(filename):
+            return None
+        # x.css.gz的mimetype为text/css, 与源文件相同
+        mimetype = guess_type(filename)[0] or self.fallback_mimetype
+        static_file = _StaticFile(filename, st, mimetype)
+        if cache is not None and st.st_size <= self.cache_file_size:
+            with open(filename, 'rb') as f:
+                static_file.data = f.read()
+            # 读取过程中文件被改写时不缓存
+            if len(static_file.data) == st.st_size:
+                cache.set(name, static_file)
+        return static_file
+
+    def lookup_gzipped(self, name, static_file):
+        """
+            查找静态文件的.gz版本, 不存在或比源文件旧时生成
+        :return: .gz文件的_StaticFile, 无法生成(如目录不可写)时返回None
+        """
+        gzipped = self.lookup(name + '.gz')
+        if gzipped is not None and gzipped.mtime >= static_file.mtime:
+            return gzipped
+        try:
+            gzip_file(static_file.filename)
+        except (IOError, OSError):
+            return None
+        return self.lookup(name + '.gz')
+
+    def serve(self, static_file, environ, start_response, extra_headers=()):
+        headers = static_file.headers + list(extra_headers)
+        # 浏览器重新验证时通常原样带回ETag, 先直接比较, 其余情况再完整解析条件请求头
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match == static_file.etag or \
+                (if_none_match or 'HTTP_IF_MODIFIED_SINCE' in environ) and \
+                not is_resource_modified(environ, static_file.etag,
+                                         last_modified=static_file.last_modified):
+            start_response('304 Not Modified', headers)
+            return []
+
+        size = static_file.size
+        start, stop = 0, size
+        status = '200 OK'
+        byte_range = self._byte_range(environ, static_file)
+        if byte_range is not None:
+            rng = byte_range.range_for_length(size)
+            if rng is None:
+                headers.append(('Content-Range', 'bytes */%d' % size))
+                headers.append(('Content-Length', '0'))
+                start_response('416 Requested Range Not Satisfiable', headers)
+                return []
+            start, stop = rng
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, size)))
+        headers.append(('Content-Length', str(stop - start)))
+        start_response(status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+
+        if static_file.data is not None:
+            if start == 0 and stop == size:
+                return [static_file.data]
+            return [static_file.data[start:stop]]
+        f = open(static_file.filename, 'rb')
+        if start == 0 and stop == size:
+            file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+            return file_wrapper(f, self.buffer_size)
+        return _read_range(f, start, stop, self.buffer_size)
+
+    def _byte_range(self, environ, static_file):
+        """
+            解析Range请求头. 格式错误、多个区间, 或If-Range与当前的ETag或Last-Modified不符时
+            忽略Range, 返回整个文件
+        """
+        value = environ.get('HTTP_RANGE')
+        if not value:
+            return None
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range and if_range not in (static_file.etag, static_file.last_modified):
+            return None
+        byte_range = parse_range_header(value)
+        if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+            return None
+        return byte_range
+
+
+def _read_range(f, start, stop, buffer_size):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(buffer_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
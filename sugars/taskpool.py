@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""
+    sugars.taskpool::
+    固定数量的常驻工作线程, 帮助调用者并发执行一组互不依赖的函数:
+
+    pool = TaskPool(workers=8)
+    results = pool.run([lambda: query_a(), lambda: query_b()])
+
+    整个pool(所有同时进行的run)最多只用workers个线程, 不会每次调用都新开线程.
+    调用者自己也参与执行, 线程全忙(包括在函数中嵌套调用run)时只是退化成在调用者中依次执行,
+    不会死锁. 线程在第一次run时才启动, gevent monkey patch之后启动的线程即greenlet.
+"""
+
+import sys
+from collections import deque
+from thread import allocate_lock
+from threading import Event, Thread
+from Queue import Queue
+
+
+class _Batch(object):
+    """
+        一次run提交的一组函数, 调用者和工作线程从tasks中取出执行, 全部完成时设置done
+    """
+    __slots__ = ('tasks', 'results', 'remaining', 'done', 'lock')
+
+    def __init__(self, funcs):
+        self.tasks = deque(enumerate(funcs))
+        self.results = [None] * len(funcs)
+        self.remaining = len(funcs)
+        self.done = Event()
+        self.lock = allocate_lock()
+
+    def work(self):
+        while True:
+            try:
+                # deque.popleft在GIL下是原子的
+                i, func = self.tasks.popleft()
+            except IndexError:
+                return
+            try:
+                self.results[i] = (True, func())
+            except:
+                self.results[i] = (False, sys.exc_info())
+            self.lock.acquire()
+            self.remaining -= 1
+            finished = self.remaining == 0
+            self.lock.release()
+            if finished:
+                self.done.set()
+
+
+class TaskPool(object):
+    """
+        最多workers个工作线程的任务池
+    """
+
+    def __init__(self, workers=8):
+        """
+        :param workers: 工作线程数, 即一次run中除调用者之外最多同时执行的函数个数;
+                        0表示全部在调用者中依次执行
+        """
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        self._lock = allocate_lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _worker(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            batch.work()
+
+    def run(self, funcs):
+        """
+            并发执行funcs, 全部完成后返回
+        :param funcs: 无参数的函数列表
+        :return: 按顺序的(ok, value)列表, ok为False时value是sys.exc_info()
+        """
+        if not funcs:
+            return []
+        batch = _Batch(funcs)
+        helpers = min(len(funcs) - 1, self.workers)
+        if helpers > 0:
+            if len(self._threads) < self.workers:
+                self._start()
+            # 工作线程取到batch时任务可能已经被取完, 直接返回
+            for i in range(helpers):
+                self._queue.put(batch)
+        batch.work()
+        batch.done.wait()
+        return batch.results
+
+    def close(self):
+        """
+            通知所有工作线程退出
+        """
+        self._lock.acquire()
+        try:
+            for thread in self._threads:
+                self._queue.put(None)
+            self._threads = []
+        finally:
+            self._lock.release()
@@ -0,0 +1,93 @@
+# coding: utf-8
+
+"""
+    sugars.templating::
+    jinja2扩展. FragmentCacheExtension提供模板片段缓存标签, 渲染结果跨请求复用:
+
+    {% cache message.message_id, 300 %}
+      <img src="{{ message.email|gravatar(size=48) }}"> ...
+    {% endcache %}
+
+    key可以是任意表达式, 和模板名、environment.fragment_cache_prefix一起组成缓存的key;
+    ttl(秒)可以省略, 省略时不过期(只会被LRU淘汰). 缓存对象保存在environment.fragment_cache,
+    只要有get(key)和set(key, value, ttl)即可, 如sugars.cache.LRUCache;
+    为None时不缓存, 每次都渲染.
+    修改fragment_cache_prefix(如换成新的版本号)之后, 旧的片段全部失效.
+
+    LazyContext是支持延迟求值变量的模板上下文, 变量的值为LazyValue时,
+    模板第一次读取它才调用函数求值, 模板没用到就不求值.
+"""
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.runtime import Context
+from jinja2.utils import missing
+
+_missing = object()
+
+
+class FragmentCacheExtension(Extension):
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(
+            fragment_cache=None,
+            fragment_cache_prefix='',
+        )
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_fragment', args),
+                               [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, template_name, key, ttl, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        key = u'%s:%s:%s' % (self.environment.fragment_cache_prefix, template_name, key)
+        rv = cache.get(key)
+        if rv is None:
+            rv = caller()
+            cache.set(key, rv, ttl)
+        return rv
+
+
+class LazyValue(object):
+    """
+        延迟求值的模板变量, 第一次读取时调用func, 之后直接返回保存的结果
+    """
+    __slots__ = ('func', 'value')
+
+    def __init__(self, func):
+        self.func = func
+        self.value = _missing
+
+    def get(self):
+        if self.value is _missing:
+            self.value = self.func()
+        return self.value
+
+
+class LazyContext(Context):
+    """
+        读取变量时展开LazyValue的模板上下文, 用作environment.context_class
+    """
+
+    def resolve_or_missing(self, key):
+        # 与jinja2默认的查找顺序相同; LazyValue只会出现在传给模板的parent中
+        if key in self.vars:
+            return self.vars[key]
+        parent = self.parent
+        if key in parent:
+            rv = parent[key]
+            if rv.__class__ is LazyValue:
+                return rv.get()
+            return rv
+        return missing
@@ -18,6 +18,26 @@ print(sys.path)
 import spoon
 import unittest
 import tempfile
+import threading
+from sugars.local import Local, LocalStack, LocalProxy
+
+
+def raw_http_get(socket, port, path):
+    """
+        用原始socket发送HTTP/1.0的GET请求, 读到连接关闭为止
+    :param socket: socket模块, 测试gevent server时传入gevent.socket
+    :return: 响应内容(不含响应头)
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall('GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' % path)
+    data = ''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    return data.split('\r\n\r\n', 1)[1]
 
 
 class ContextTestCase(unittest.TestCase):
@@ -38,6 +58,23 @@ class ContextTestCase(unittest.TestCase):
             print meh()
             assert meh() == 'http://localhost/meh'
 
+    def test_proxies_and_current_context(self):
+        app = spoon.Spoon(__name__)
+        assert repr(spoon.request) == '<LocalProxy unbound>'
+        assert not spoon.g
+        assert spoon.current_context() is None
+        self.assertRaises(RuntimeError, getattr, spoon.request, 'args')
+        with app.test_request_context('/?name=World'):
+            ctx = spoon.current_context()
+            assert spoon.current_app == app
+            assert spoon.request._get_current_object() is ctx.request
+            assert spoon.request.args['name'] == 'World'
+            spoon.g.value = 42
+            assert ctx.g.value == 42
+            with app.test_request_context('/inner'):
+                assert spoon.request.path == '/inner'
+            assert spoon.request.path == '/'
+
 
 class BasicFunctionality(unittest.TestCase):
 
@@ -79,6 +116,172 @@ class BasicFunctionality(unittest.TestCase):
         assert c.post('/set', data={'value': '42'}).data == 'value set'
         assert c.get('/get').data == '42'
 
+    def test_json_session_serializer(self):
+        from datetime import datetime
+        from sugars.session import JSONSerializer
+        serializer = JSONSerializer(compress_threshold=64)
+        data = {'user_id': 1, 'pair': (1, u'x'), 'when': datetime(2019, 7, 1, 8, 30),
+                '_flashes': ['You were logged in'] * 10}
+        cookie = serializer.dumps(data, 'testkey')
+        assert cookie.startswith('.')
+        assert serializer.loads(cookie, 'testkey') == data
+        assert serializer.loads(cookie, 'otherkey') is None
+        assert serializer.loads('x' + cookie, 'testkey') is None
+        assert serializer.loads('garbage', 'testkey') is None
+        assert not serializer.dumps({'a': 1}, 'testkey').startswith('.')
+
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        app.session_serializer = serializer
+        @app.route('/set', methods=['POST'])
+        def set():
+            spoon.session['value'] = spoon.request.form['value']
+            return 'value set'
+        @app.route('/get')
+        def get():
+            return spoon.session.get('value', 'missing')
+        c = app.test_client()
+        rv = c.post('/set', data={'value': '42'})
+        value = rv.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+        assert serializer.loads(value, 'testkey') == {'value': '42'}
+        assert c.get('/get').data == '42'
+        c.set_cookie('localhost', 'session', value[:-2] + 'xx')
+        assert c.get('/get').data == 'missing'
+
+    def test_unmodified_session_not_saved(self):
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        @app.route('/login')
+        def login():
+            spoon.session['user_id'] = 1
+            spoon.flash('logged in')
+            return 'ok'
+        @app.route('/')
+        def timeline():
+            flashes = spoon.get_flashed_messages()
+            spoon.session.setdefault('user_id', 2)
+            spoon.session.pop('missing', None)
+            return '%s|%s' % (spoon.session['user_id'], ','.join(flashes))
+        @app.route('/static-ish')
+        def static_ish():
+            return 'ok'
+
+        c = app.test_client()
+        assert 'Set-Cookie' in c.get('/login').headers
+        rv = c.get('/')
+        assert rv.data == '1|logged in'
+        assert 'Set-Cookie' in rv.headers
+        for path in ('/', '/', '/static-ish'):
+            rv = c.get(path)
+            assert 'Set-Cookie' not in rv.headers
+        assert rv.data == 'ok'
+        assert app.session_save_stats == dict(saved=2, skipped=3)
+
+    def test_server_side_session(self):
+        from sugars.session import MemorySessionStore, SqliteSessionStore
+        db = tempfile.NamedTemporaryFile()
+
+        def make_app(store):
+            app = spoon.Spoon(__name__)
+            app.session_store = store
+            @app.route('/set', methods=['POST'])
+            def set():
+                spoon.session['value'] = spoon.request.form['value']
+                spoon.flash('saved')
+                return 'value set'
+            @app.route('/get')
+            def get():
+                return spoon.session.get('value', 'missing')
+            @app.route('/clear')
+            def clear():
+                spoon.session.clear()
+                return 'cleared'
+            return app
+
+        for store in (MemorySessionStore(), SqliteSessionStore(db.name)):
+            c = make_app(store).test_client()
+            rv = c.get('/get')
+            assert rv.data == 'missing'
+            assert 'Set-Cookie' not in rv.headers
+            rv = c.post('/set', data={'value': '42'})
+            sid = rv.headers['Set-Cookie'].split(';')[0].split('=')[1]
+            assert store.is_valid_key(sid)
+            assert store.get(sid)['_flashes'] == ['saved']
+            rv = c.get('/get')
+            assert rv.data == '42'
+            assert 'Set-Cookie' not in rv.headers
+            assert 'Max-Age=0' in c.get('/clear').headers['Set-Cookie']
+            assert c.get('/get').data == 'missing'
+            assert store.get(sid).new
+
+        # sqlite存储在store重建后依然有效
+        c = make_app(SqliteSessionStore(db.name)).test_client()
+        c.post('/set', data={'value': 'persisted'})
+        c.application.session_store = SqliteSessionStore(db.name, cache_size=0)
+        assert c.get('/get').data == 'persisted'
+
+    def test_sqlite_session_expiry(self):
+        import sqlite3
+        import time
+        from contextlib import closing
+        from cPickle import dumps
+        from sugars.session import SqliteSessionStore
+        db = tempfile.NamedTemporaryFile()
+        # 没有updated列的旧文件, 已有的session保留
+        with closing(sqlite3.connect(db.name)) as conn:
+            conn.execute('create table spoon_sessions (sid text primary key, data blob not null)')
+            conn.execute("insert into spoon_sessions values ('old', ?)",
+                         (sqlite3.Binary(dumps({'a': 1})),))
+            conn.commit()
+        store = SqliteSessionStore(db.name, cache_size=0, max_age=60, purge_interval=None)
+        assert store.get('old')['a'] == 1
+
+        session = store.new()
+        session['flash'] = 'x'
+        store.save(session)
+        assert store.get(session.sid)['flash'] == 'x'
+        with closing(sqlite3.connect(db.name)) as conn:
+            conn.execute('update spoon_sessions set updated = ? where sid = ?',
+                         (time.time() - 120, session.sid))
+            conn.commit()
+        # 过期的行视为不存在, purge时删除
+        assert store.get(session.sid).new
+        assert store.purge() == 1
+        assert store.purge() == 0
+
+        # save()每隔purge_interval秒自动清理
+        with closing(sqlite3.connect(db.name)) as conn:
+            conn.execute('update spoon_sessions set updated = ?', (time.time() - 120,))
+            conn.commit()
+        store = SqliteSessionStore(db.name, max_age=60, purge_interval=0)
+        session = store.new()
+        store.save(session)
+        with closing(sqlite3.connect(db.name)) as conn:
+            rows = conn.execute('select sid from spoon_sessions').fetchall()
+        assert rows == [(session.sid,)]
+
+    def test_lazy_request_context(self):
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        contexts = []
+        @app.route('/health')
+        def health():
+            contexts.append(spoon._request_ctx_stack.top)
+            return 'ok'
+        @app.route('/set')
+        def set():
+            spoon.session['value'] = 42
+            return 'value set'
+        c = app.test_client()
+        rv = c.get('/health')
+        assert rv.data == 'ok'
+        assert 'Set-Cookie' not in rv.headers
+        ctx = contexts[0]
+        assert not ctx.session_loaded
+        assert 'url_adapter' not in ctx.__dict__
+        assert 'request' not in ctx.__dict__
+        assert 'Set-Cookie' in c.get('/set').headers
+
     def test_request_processing(self):
         app = spoon.Spoon(__name__)
         evts = []
@@ -122,6 +325,74 @@ class BasicFunctionality(unittest.TestCase):
         assert rv.status_code == 500
         assert 'internal server error' in rv.data
 
+    def test_response_cache(self):
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        calls = []
+        @app.route('/', methods=['GET', 'POST'])
+        @app.cached(ttl=60)
+        def index():
+            calls.append(spoon.request.method)
+            return 'page %s' % spoon.request.args.get('page', 1)
+        @app.route('/login/<int:user_id>')
+        def login(user_id):
+            spoon.session['user_id'] = user_id
+            return 'ok'
+        @app.route('/me')
+        @app.cached(session_key='user_id')
+        def me():
+            calls.append('me')
+            return 'user %s' % spoon.session.get('user_id')
+        c = app.test_client()
+        rv = c.get('/')
+        assert rv.data == 'page 1'
+        etag = rv.headers['ETag']
+        rv = c.get('/')
+        assert rv.data == 'page 1'
+        assert rv.headers['ETag'] == etag
+        assert c.get('/?page=2').data == 'page 2'
+        assert calls == ['GET', 'GET']
+
+        rv = c.get('/', headers=[('If-None-Match', etag)])
+        assert rv.status_code == 304
+        assert rv.data == ''
+        assert rv.headers['ETag'] == etag
+        assert c.post('/').data == 'page 1'
+        assert calls == ['GET', 'GET', 'POST']
+        stats = app.response_cache.stats()
+        assert (stats['hits'], stats['misses']) == (2, 2)
+
+        assert c.get('/me').data == 'user None'
+        c.get('/login/1')
+        assert c.get('/me').data == 'user 1'
+        assert c.get('/me').headers['Vary'] == 'Cookie'
+        assert calls.count('me') == 2
+
+    def test_response_cache_skips_session(self):
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        @app.route('/flash')
+        def flash():
+            spoon.flash('hello')
+            return 'ok'
+        @app.route('/')
+        @app.cached(ttl=60)
+        def index():
+            return 'flashes: %s' % ', '.join(spoon.get_flashed_messages())
+        @app.route('/me')
+        @app.cached(session_key='user_id')
+        def me():
+            return 'flashes: %s' % ', '.join(spoon.get_flashed_messages())
+        for url in ('/', '/me'):
+            a = app.test_client()
+            b = app.test_client()
+            a.get('/flash')
+            assert a.get(url).data == 'flashes: hello'
+            assert b.get(url).data == 'flashes: '
+            assert a.get(url).data == 'flashes: '
+        # 读取过session又没有session_key的'/'从不缓存; '/me'只缓存了没有修改session的响应
+        assert app.response_cache.stats()['size'] == 1
+
     def test_response_creation(self):
         app = spoon.Spoon(__name__)
         @app.route('/unicode')
@@ -150,6 +421,54 @@ class BasicFunctionality(unittest.TestCase):
         with app.test_request_context():
             assert spoon.url_for('hello', name='test x') == '/hello/test%20x'
 
+    def test_url_builders_match_url_adapter(self):
+        app = spoon.Spoon(__name__)
+        @app.route('/')
+        def index():
+            pass
+        @app.route('/<username>')
+        def user(username):
+            pass
+        @app.route('/page/', defaults={'page': 1})
+        @app.route('/page/<int:page>')
+        def page(page):
+            pass
+        @app.route('/edit', methods=['POST'])
+        def edit_post():
+            pass
+        app.add_url_rule('/edit/form', 'edit_post')
+        app.add_url_rule('/x', 'api', subdomain='api')
+        cases = [
+            ('api', {}),
+            ('index', {}),
+            ('index', {'q': 'a b', 'x': None}),
+            ('user', {'username': u'j\xf6e'}),
+            ('page', {}),
+            ('page', {'page': 1}),
+            ('page', {'page': 3, 'sort': ['a', 'b']}),
+            ('edit_post', {}),
+            ('static', {'filename': 'style.css'}),
+        ]
+        for kwargs in ({}, {'method': 'POST'}, {'base_url': 'https://localhost/'},
+                       {'environ_overrides': {'SCRIPT_NAME': '/app/'}}):
+            with app.test_request_context('/', **kwargs):
+                adapter = spoon._request_ctx_stack.top.url_adapter
+                for endpoint, values in cases:
+                    expected = adapter.build(endpoint, dict(values))
+                    for i in range(2):
+                        rv = spoon.url_for(endpoint, **values)
+                        assert rv == expected, (endpoint, values, rv, expected)
+                        assert type(rv) is type(expected)
+                try:
+                    spoon.url_for('user')
+                except spoon.BuildError:
+                    pass
+                else:
+                    assert False, 'expected BuildError'
+        assert app.url_build_memo[('index', 'GET', '/app/')] == '/app/'
+        app.add_url_rule('/more', 'more')
+        assert not app.url_build_memo
+
     def test_static_files(self):
         app = spoon.Spoon(__name__)
         rv = app.test_client().get('/static/index.html')
@@ -159,9 +478,748 @@ class BasicFunctionality(unittest.TestCase):
             assert spoon.url_for('static', filename='index.html') \
                 == '/static/index.html'
 
+    def test_static_fingerprint(self):
+        import hashlib
+        class App(spoon.Spoon):
+            static_fingerprint = True
+            compress_min_size = 10
+        app = App(__name__)
+        with open(os.path.join(app.root_path, 'static', 'index.html'), 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:10]
+        with app.test_request_context():
+            url = spoon.url_for('static', filename='index.html')
+            assert url == '/static/index.%s.html' % digest
+            assert spoon.url_for('static', filename='missing.css') == '/static/missing.css'
+        c = app.test_client()
+        rv = c.get(url)
+        assert rv.data.strip() == '<h1>Hello World!</h1>'
+        assert rv.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+        rv = c.get('/static/index.html')
+        assert rv.data.strip() == '<h1>Hello World!</h1>'
+        assert rv.headers['Cache-Control'] == 'public, max-age=43200'
+        assert c.get('/static/index.0123456789.html').status_code == 404
+        # 带hash的url同样发送预先压缩的.gz文件
+        gz = os.path.join(app.root_path, 'static', 'index.html.gz')
+        try:
+            rv = c.get(url, headers=[('Accept-Encoding', 'gzip')])
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert rv.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+            assert os.path.exists(gz)
+        finally:
+            if os.path.exists(gz):
+                os.unlink(gz)
+
+    def test_static_file_handler(self):
+        import shutil
+        from sugars.static import StaticFiles
+        static_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(static_dir, 'style.css'), 'w') as f:
+                f.write('body { color: red }')
+            big = ''.join(chr(i % 256) for i in range(1000))
+            with open(os.path.join(static_dir, 'big.bin'), 'wb') as f:
+                f.write(big)
+            app = spoon.Spoon(__name__)
+            app.wsgi_app = static = StaticFiles(app.wsgi_app, '/assets', static_dir,
+                                                cache_file_size=100)
+            c = app.test_client()
+            rv = c.get('/assets/style.css')
+            assert rv.status_code == 200
+            assert rv.data == 'body { color: red }'
+            assert rv.headers['Content-Type'] == 'text/css; charset=utf-8'
+            assert rv.headers['Cache-Control'] == 'public, max-age=43200'
+            etag = rv.headers['ETag']
+            rv = c.get('/assets/style.css', headers=[('If-None-Match', etag)])
+            assert rv.status_code == 304
+            assert rv.data == ''
+            rv = c.get('/assets/style.css', headers=[
+                ('If-Modified-Since', rv.headers['Last-Modified'])])
+            assert rv.status_code == 304
+
+            rv = c.get('/assets/style.css', headers=[('Range', 'bytes=2-5')])
+            assert rv.status_code == 206
+            assert rv.data == 'dy {'
+            assert rv.headers['Content-Range'] == 'bytes 2-5/19'
+            rv = c.get('/assets/style.css', headers=[('Range', 'bytes=100-')])
+            assert rv.status_code == 416
+            rv = c.get('/assets/style.css', headers=[('Range', 'bytes=2-5'),
+                                                     ('If-Range', '"other"')])
+            assert rv.status_code == 200
+            assert rv.data == 'body { color: red }'
+
+            assert c.get('/assets/big.bin').data == big
+            rv = c.get('/assets/big.bin', headers=[('Range', 'bytes=-10')])
+            assert rv.status_code == 206
+            assert rv.data == big[-10:]
+            # 只有小文件在内存缓存中
+            assert static.cache.stats()['size'] == 19
+
+            with open(os.path.join(static_dir, 'style.css'), 'w') as f:
+                f.write('body { color: blue }')
+            assert c.get('/assets/style.css').data == 'body { color: blue }'
+            assert c.get('/assets/missing.css').status_code == 404
+            assert c.get('/assets/../secret').status_code == 404
+        finally:
+            shutil.rmtree(static_dir)
+
+    def test_gzip_compression(self):
+        import zlib
+        def gunzip(data):
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        app = spoon.Spoon(__name__)
+        page = '<p>%s</p>' % ('hello ' * 200)
+        @app.route('/')
+        def index():
+            return page
+        @app.route('/small')
+        def small():
+            return 'small'
+        @app.route('/png')
+        def png():
+            return spoon.Response(page, mimetype='image/png')
+        @app.route('/stream')
+        def stream():
+            return spoon.Response(iter(['a' * 300, 'b' * 300]))
+        c = app.test_client()
+        gzip = [('Accept-Encoding', 'gzip, deflate')]
+        rv = c.get('/', headers=gzip)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        assert int(rv.headers['Content-Length']) == len(rv.data) < len(page)
+        assert gunzip(rv.data) == page
+        assert 'Content-Encoding' not in c.get('/').headers
+        assert c.get('/', headers=[('Accept-Encoding', 'gzip;q=0')]).data == page
+        assert c.get('/small', headers=gzip).data == 'small'
+        assert c.get('/png', headers=gzip).data == page
+        rv = c.get('/stream', headers=gzip)
+        assert 'Content-Length' not in rv.headers
+        assert gunzip(rv.data) == 'a' * 300 + 'b' * 300
+
+        # HEAD的响应头与GET一致
+        rv = c.head('/', headers=gzip)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        assert 'Content-Length' not in rv.headers
+        assert rv.data == ''
+        assert c.head('/').headers['Content-Length'] == str(len(page))
+        rv = c.head('/small', headers=gzip)
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.headers['Content-Length'] == '5'
+
+        class App(spoon.Spoon):
+            compress_min_size = 10
+        app = App(__name__)
+        source = os.path.join(app.root_path, 'static', 'index.html')
+        try:
+            rv = app.test_client().get('/static/index.html', headers=gzip)
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert rv.headers['Content-Type'].startswith('text/html')
+            assert gunzip(rv.data).strip() == '<h1>Hello World!</h1>'
+            with open(source + '.gz', 'rb') as f:
+                assert f.read() == rv.data
+        finally:
+            if os.path.exists(source + '.gz'):
+                os.unlink(source + '.gz')
+
+
+class Routing(unittest.TestCase):
+
+    def test_literal_routes_match_like_url_map(self):
+        app = spoon.Spoon(__name__)
+        @app.route('/public')
+        def public():
+            return 'public'
+        @app.route('/login', methods=['GET', 'POST'])
+        def login():
+            return spoon.request.method
+        @app.route('/folder/')
+        def folder():
+            return 'folder'
+        @app.route('/<username>')
+        def user(username):
+            return username
+        assert app.literal_routes['/public'][0][1] == 'public'
+        assert app.literal_routes['/folder'] is None
+
+        c = app.test_client()
+        assert c.get('/public').data == 'public'
+        assert c.post('/login').data == 'POST'
+        rv = c.head('/public')
+        assert rv.status_code == 200
+        assert not rv.data
+        rv = c.delete('/login')
+        assert rv.status_code == 405
+        assert sorted(rv.allow) == ['GET', 'HEAD', 'POST']
+        rv = c.get('/folder')
+        assert rv.status_code in (301, 308)
+        assert rv.headers['Location'] == 'http://localhost/folder/'
+        assert c.get('/folder/').data == 'folder'
+        assert c.get('/joe').data == 'joe'
+        assert c.get('/joe/x').status_code == 404
+
+        paths = ['/public', '/login', '/folder', '/folder/', '/joe', '//public']
+        for method in ('GET', 'HEAD', 'POST', 'PUT'):
+            for path in paths:
+                with app.test_request_context(path, method=method):
+                    try:
+                        expected = spoon._request_ctx_stack.top.url_adapter.match()
+                    except spoon.HTTPException, e:
+                        expected = e.code
+                    try:
+                        rv = app.match_request()
+                    except spoon.HTTPException, e:
+                        rv = e.code
+                    assert rv == expected, (method, path, rv, expected)
+
+    def test_literal_routes_defaults_order(self):
+        # 带defaults的Rule先加入或后加入, 结果都与url_map(包括redirect_defaults的重定向)一致
+        rules = [('/page', {}), ('/page/', dict(defaults={'page': 1})),
+                 ('/page/<int:page>', {}), ('/first', dict(defaults={'page': 1}))]
+        for order in (rules, rules[::-1]):
+            app = spoon.Spoon(__name__)
+            for rule, options in order:
+                app.add_url_rule(rule, 'page', **options)
+            for path in ('/page', '/page/', '/page/1', '/page/2', '/first'):
+                with app.test_request_context(path):
+                    try:
+                        expected = spoon._request_ctx_stack.top.url_adapter.match()
+                    except spoon.HTTPException, e:
+                        expected = e.code
+                    try:
+                        rv = app.match_request()
+                    except spoon.HTTPException, e:
+                        rv = e.code
+                    assert rv == expected, (order, path, rv, expected)
+
+    def test_url_match_cache(self):
+        app = spoon.Spoon(__name__)
+        app.url_match_cache = spoon.LRUCache(2)
+        @app.route('/spoon/<int:spoon_id>')
+        def show(spoon_id):
+            return 'NO.%d' % spoon_id
+        c = app.test_client()
+        assert c.get('/spoon/1').data == 'NO.1'
+        assert c.get('/spoon/1').data == 'NO.1'
+        assert c.get('/spoon/x').status_code == 404
+        assert app.url_match_cache.stats() == dict(hits=1, misses=2,
+                                                   size=1, maxsize=2)
+        c.get('/spoon/2')
+        c.get('/spoon/3')
+        assert len(app.url_match_cache) == 2
+        assert ('localhost', 'GET', '/spoon/1') not in app.url_match_cache
+
+        @app.route('/spoon/<path:name>')
+        def other(name):
+            return name
+        assert len(app.url_match_cache) == 0
+        assert c.get('/spoon/3').data == 'NO.3'
+
+
+class LocalTestCase(unittest.TestCase):
+
+    def test_local_isolation(self):
+        lc = Local()
+        stack = LocalStack()
+        top = LocalProxy(lambda: stack.top)
+        lc.value = 'main'
+        stack.push('main')
+        seen = []
+
+        def worker(i):
+            assert not hasattr(lc, 'value')
+            lc.value = i
+            stack.push(i)
+            for j in range(1000):
+                assert lc.value == i
+                assert top == i
+            seen.append((lc.value, stack.pop(), stack.top))
+            # 线程结束后ident可能被新线程复用
+            lc.__release_local__()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(seen) == [(i, i, None) for i in range(8)]
+        assert lc.value == 'main'
+        assert top == 'main'
+        del lc.value
+        self.assertRaises(AttributeError, getattr, lc, 'value')
+
+    def test_stack_storage_released(self):
+        stack = LocalStack()
+        stack.push(1)
+        stack.push(2)
+        assert stack.pop() == 2
+        assert stack.pop() == 1
+        assert stack.pop() is None
+        assert stack._local.__storage__ == {}
+
+    def test_greenlet_storage_stays_flat(self):
+        try:
+            from greenlet import greenlet
+        except ImportError:
+            return
+        stack = LocalStack()
+        object.__setattr__(stack._local, '__ident_func__', greenlet.getcurrent)
+        storage = stack._local.__storage__
+
+        def handle(i):
+            stack.push(i)
+            greenlet.getcurrent().parent.switch()
+            assert stack.top == i
+            stack.pop()
+
+        for batch in range(100):
+            running = [greenlet(handle) for i in range(1000)]
+            for i, g in enumerate(running):
+                g.switch(i)
+            assert len(storage) == 1000
+            for g in running:
+                g.switch()
+            assert len(storage) == 0
+
+    def test_request_context_storage_released(self):
+        app = spoon.Spoon(__name__)
+        app.preserved_context_limit = 4
+        @app.route('/')
+        def index():
+            return 'ok'
+        @app.route('/error')
+        def error():
+            1/0
+        storage = spoon._request_ctx_stack._local.__storage__
+        barrier = threading.Event()
+        results = []
+
+        def worker(path):
+            try:
+                results.append(app.test_client().get(path).data)
+            except ZeroDivisionError:
+                results.append('error')
+            barrier.wait()
+
+        def run(path, count):
+            barrier.clear()
+            threads = [threading.Thread(target=worker, args=(path,))
+                       for i in range(count)]
+            for t in threads:
+                t.start()
+            # 所有线程都处理完请求后才放行, 保证ident各不相同
+            while len(results) < count:
+                barrier.wait(0.01)
+            barrier.set()
+            for t in threads:
+                t.join()
+
+        run('/', 200)
+        assert results == ['ok'] * 200
+        assert len(storage) == 0
+
+        del results[:]
+        app.debug = True
+        run('/error', 50)
+        assert results == ['error'] * 50
+        assert len(storage) == 4
+        with app.test_request_context('/'):
+            pass
+        assert len(storage) == 4
+        # 释放保留的上下文, 以免留在共享的storage中影响其他测试对storage大小的检查
+        for ctx in app.preserved_contexts:
+            spoon._request_ctx_stack.release(ctx.ident)
+        assert len(storage) == 0
+
+
+class Concurrency(unittest.TestCase):
+
+    def test_greenlets_do_not_share_request(self):
+        try:
+            import gevent
+        except ImportError:
+            return
+        app = spoon.Spoon(__name__)
+        @app.route('/<int:n>')
+        def show(n):
+            spoon.g.n = n
+            for i in range(3):
+                gevent.sleep(0)
+                assert spoon.request.path == '/%d' % n
+                assert spoon.g.n == n
+            return str(n)
+
+        jobs = [gevent.spawn(lambda n=n: app.test_client().get('/%d' % n).data)
+                for n in range(500)]
+        gevent.joinall(jobs, raise_error=True)
+        assert [job.value for job in jobs] == [str(n) for n in range(500)]
+        assert len(spoon._request_ctx_stack._local.__storage__) == 0
+
+    def test_gather(self):
+        import time
+        app = spoon.Spoon(__name__)
+
+        def fetch(n):
+            def call():
+                time.sleep(0.1)
+                ident = spoon._request_ctx_stack.__ident_func__()
+                return ident, '%s-%d-%s' % (spoon.request.args['q'], n, spoon.g.user)
+            return call
+
+        def fail():
+            raise ZeroDivisionError()
+
+        idents = []
+        @app.route('/')
+        def index():
+            spoon.g.user = 'u'
+            start = time.time()
+            rv = spoon.gather(fetch(1), fetch(2), fetch(3))
+            assert time.time() - start < 0.25
+            idents.extend(ident for ident, value in rv)
+            return ' '.join(value for ident, value in rv)
+
+        @app.route('/error')
+        def error():
+            spoon.g.user = 'u'
+            try:
+                spoon.gather(fetch(1), fail)
+            except ZeroDivisionError:
+                return 'caught'
+
+        @app.route('/form', methods=['POST'])
+        def form():
+            a, b = spoon.gather(lambda: spoon.request.form.get('a'),
+                                lambda: spoon.request.form.get('b'))
+            return '%s %s' % (a, b)
+
+        c = app.test_client()
+        assert c.get('/?q=x').data == 'x-1-u x-2-u x-3-u'
+        assert len(set(idents)) == 3
+        # 工作线程执行完后请求上下文已经出栈
+        for ident in idents:
+            assert spoon._request_ctx_stack.stack_of(ident) == []
+        assert c.get('/error?q=x').data == 'caught'
+        for i in range(20):
+            assert c.post('/form', data=dict(a='1', b=str(i))).data == '1 %d' % i
+        self.assertRaises(RuntimeError, spoon.gather)
+
+    def test_gather_workers(self):
+        import time
+        class App(spoon.Spoon):
+            gather_workers = 2
+        app = App(__name__)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def call():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return spoon.request.path
+
+        with app.test_request_context('/x'):
+            assert spoon.gather(*[call] * 6) == ['/x'] * 6
+            assert spoon.gather() == []
+        # 2个工作线程加上调用者自己
+        assert peak[0] == 3
+        assert len(app.gather_pool._threads) == 2
+
+    def test_request_coalescing(self):
+        import time
+        app = spoon.Spoon(__name__)
+        calls = []
+        @app.route('/slow', coalesce=True)
+        def slow():
+            calls.append(spoon.request.args.get('q'))
+            time.sleep(0.3)
+            return 'result %s' % spoon.request.args.get('q')
+        @app.route('/timeout', coalesce=0.05)
+        def timeout():
+            calls.append('timeout')
+            time.sleep(0.3)
+            return 'done'
+
+        def run_concurrently(urls):
+            results = []
+            def worker(url):
+                results.append(app.test_client().get(url).data)
+            threads = [threading.Thread(target=worker, args=(url,)) for url in urls]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            return sorted(results)
+
+        assert run_concurrently(['/slow?q=1'] * 8) == ['result 1'] * 8
+        assert calls == ['1']
+        assert app.single_flight.stats() == dict(calls=1, shared=7, fallbacks=0,
+                                                 in_flight=0)
+        assert run_concurrently(['/slow?q=2'] * 3 + ['/slow?q=3'] * 3) == \
+            ['result 2'] * 3 + ['result 3'] * 3
+        assert sorted(calls) == ['1', '2', '3']
+
+        # 等待超时后自己调用视图函数
+        del calls[:]
+        assert run_concurrently(['/timeout'] * 4) == ['done'] * 4
+        assert calls == ['timeout'] * 4
+
+    def test_request_coalescing_skips_session(self):
+        import time
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        calls = []
+        @app.route('/login/<name>')
+        def login(name):
+            spoon.session['user'] = name
+            spoon.flash('welcome %s' % name)
+            return 'ok'
+        @app.route('/home', coalesce=True)
+        def home():
+            calls.append(spoon.session.get('user'))
+            time.sleep(0.2)
+            return 'hello %s %s' % (spoon.session.get('user'),
+                                    ', '.join(spoon.get_flashed_messages()))
+
+        names = ['alice', 'bob', 'carol']
+        clients = dict((name, app.test_client()) for name in names)
+        for name, c in clients.items():
+            c.get('/login/' + name)
+        results = {}
+        def worker(name):
+            results[name] = clients[name].get('/home').data
+        threads = [threading.Thread(target=worker, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 读取过session的响应不共享, 每个用户看到自己的页面和flash消息
+        for name in names:
+            assert results[name] == 'hello %s welcome %s' % (name, name)
+            assert clients[name].get('/home').data == 'hello %s ' % name
+        assert sorted(calls[:3]) == names
+
+    def test_gevent_server(self):
+        try:
+            import gevent
+            from gevent import socket
+        except ImportError:
+            return
+        from sugars.serving import make_gevent_server
+        app = spoon.Spoon(__name__)
+        @app.route('/slow/<int:n>')
+        def slow(n):
+            gevent.sleep(0.05)
+            return '%d:%s' % (n, spoon.request.args['q'])
+
+        server = make_gevent_server('127.0.0.1', 0, app, log=None)
+        server.start()
+
+        def fetch(n):
+            return raw_http_get(socket, server.server_port, '/slow/%d?q=%d' % (n, n))
+
+        try:
+            jobs = [gevent.spawn(fetch, n) for n in range(100)]
+            gevent.joinall(jobs, timeout=5, raise_error=True)
+        finally:
+            server.stop()
+        assert [job.value for job in jobs] == ['%d:%d' % (n, n) for n in range(100)]
+
+    def test_gevent_server_bounded(self):
+        try:
+            import gevent
+            from gevent import socket
+        except ImportError:
+            return
+        from sugars.serving import make_gevent_server
+        app = spoon.Spoon(__name__)
+        active = []
+        peak = []
+        @app.route('/<int:n>')
+        def slow(n):
+            active.append(n)
+            peak.append(len(active))
+            gevent.sleep(0.02)
+            # 等待期间其他greenlet的请求不会影响这里的request
+            assert spoon.request.path == '/%d' % n
+            active.remove(n)
+            return str(n)
+
+        server = make_gevent_server('127.0.0.1', 0, app, spawn=5, log=None)
+        server.start()
+
+        def fetch(n):
+            return raw_http_get(socket, server.server_port, '/%d' % n)
+
+        try:
+            jobs = [gevent.spawn(fetch, n) for n in range(30)]
+            gevent.joinall(jobs, timeout=5, raise_error=True)
+        finally:
+            server.stop()
+        assert [job.value for job in jobs] == [str(n) for n in range(30)]
+        assert max(peak) == 5
+
+    def test_prefork_server(self):
+        import signal
+        import time
+        import urllib2
+        from sugars.serving import PreforkServer
+        app = spoon.Spoon(__name__)
+        @app.route('/pid')
+        def pid():
+            return str(os.getpid())
+        @app.route('/slow')
+        def slow():
+            time.sleep(0.5)
+            return 'finished'
+        @app.route('/crash')
+        def crash():
+            os._exit(1)
+
+        import logging
+        logger = logging.getLogger('werkzeug')
+        level = logger.level
+        logger.setLevel(logging.ERROR)
+        self.addCleanup(logger.setLevel, level)
+        server = PreforkServer('127.0.0.1', 0, app, workers=2, graceful_timeout=5)
+        server.poll_interval = 0.1
+        url = 'http://127.0.0.1:%d' % server.server_port
+        master = os.fork()
+        if not master:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server.socket.close()
+
+        def get(path):
+            return urllib2.urlopen(url + path, timeout=5).read()
+
+        try:
+            pids = set(get('/pid') for i in range(20))
+            assert 1 <= len(pids) <= 2
+            assert str(master) not in pids
+            # 崩溃的worker被重新fork出来
+            for i in range(2):
+                try:
+                    get('/crash')
+                except Exception:
+                    pass
+            new_pids = set(get('/pid') for i in range(20))
+            assert new_pids - pids
+
+            # SIGTERM时处理中的请求照常完成
+            results = []
+            t = threading.Thread(target=lambda: results.append(get('/slow')))
+            t.start()
+            time.sleep(0.2)
+        finally:
+            os.kill(master, signal.SIGTERM)
+        t.join()
+        assert results == ['finished']
+        assert os.waitpid(master, 0)[1] == 0
+        for pid in pids | new_pids:
+            try:
+                os.kill(int(pid), 0)
+            except OSError:
+                pass
+            else:
+                assert False, 'worker %s still running' % pid
+
+    def test_thread_pool_server(self):
+        import logging
+        import socket
+        import time
+        from sugars.serving import make_pool_server
+        logger = logging.getLogger('werkzeug')
+        level = logger.level
+        logger.setLevel(logging.ERROR)
+        self.addCleanup(logger.setLevel, level)
+        app = spoon.Spoon(__name__)
+        release = threading.Event()
+        @app.route('/wait')
+        def wait():
+            release.wait(5)
+            return 'done'
+        server = make_pool_server('127.0.0.1', 0, app, workers=2, queue_size=1,
+                                  retry_after=3)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def connect():
+            sock = socket.create_connection(('127.0.0.1', server.server_port), 5)
+            sock.sendall('GET /wait HTTP/1.0\r\nHost: localhost\r\n\r\n')
+            return sock
+
+        def read(sock):
+            data = ''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            return data
+
+        def wait_for(**expected):
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                stats = server.stats()
+                if all(stats[k] == v for k, v in expected.items()):
+                    return stats
+                time.sleep(0.01)
+            assert False, server.stats()
+
+        try:
+            accepted = [connect(), connect()]
+            wait_for(busy=2, utilization=1.0)
+            accepted.append(connect())
+            wait_for(queued=1)
+            for i in range(3):
+                rv = read(connect())
+                assert rv.startswith('HTTP/1.1 503')
+                assert 'Retry-After: 3\r\n' in rv
+            release.set()
+            for sock in accepted:
+                assert read(sock).endswith('\r\n\r\ndone')
+            stats = wait_for(completed=3)
+            assert (stats['accepted'], stats['rejected'], stats['busy']) == (3, 3, 0)
+            assert stats['wait_max'] > 0
+        finally:
+            release.set()
+            server.shutdown()
+            thread.join()
+
+        # queue_size=0: 线程全忙时立即拒绝
+        server = make_pool_server('127.0.0.1', 0, app, workers=4, queue_size=0)
+        assert server.queue_size == 0
+        server.server_close()
+
+        # app.run启动的server保存在app.server中
+        thread = threading.Thread(target=app.run, args=('127.0.0.1', 0),
+                                  kwargs=dict(server='pool', workers=2))
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + 5
+        while app.server is None and time.time() < deadline:
+            time.sleep(0.01)
+        try:
+            assert app.server.stats()['workers'] == 2
+        finally:
+            app.server.shutdown()
+            thread.join()
+
 
 class Templating(unittest.TestCase):
 
+    def test_jinja_env_overlay(self):
+        app = spoon.Spoon(__name__)
+        assert app.jinja_env.overlay().cache.capacity == app.template_cache_size
+
     def test_context_processing(self):
         app = spoon.Spoon(__name__)
         @app.context_processor
@@ -173,6 +1231,151 @@ class Templating(unittest.TestCase):
         rv = app.test_client().get('/')
         assert rv.data == '<p>23|42'
 
+    def test_lazy_context_processor(self):
+        app = spoon.Spoon(__name__)
+        calls = []
+        @app.context_processor
+        def context_processor():
+            calls.append('processor')
+            return {'injected_value': spoon.lazy(lambda: calls.append('lazy') or 42)}
+        @app.route('/')
+        def index():
+            return spoon.render_template('context_template.html', value=23) + \
+                spoon.render_template('context_template.html', value=24)
+        @app.route('/unused')
+        def unused():
+            return spoon.render_template('fragment_template.html', key='a', value=1)
+        c = app.test_client()
+        assert c.get('/unused').data == '1|1'
+        assert calls == ['processor']
+        assert c.get('/').data == '<p>23|42<p>24|42'
+        assert calls == ['processor', 'processor', 'lazy']
+
+    def test_precompile_with_bytecode_cache(self):
+        import shutil
+        cache_dir = tempfile.mkdtemp()
+        try:
+            class App(spoon.Spoon):
+                template_bytecode_cache = cache_dir
+            app = App(__name__)
+            names = app.precompile_templates()
+            assert names == ['context_template.html', 'escaping_template.html',
+                             'fragment_template.html', 'stream_template.html']
+            assert len(os.listdir(cache_dir)) == 4
+            assert len(app.jinja_env.cache) == 4
+
+            # 新进程(新的app)直接从字节码缓存加载, 不再编译
+            app = App(__name__)
+            compiled = []
+            compile_ = app.jinja_env.compile
+            app.jinja_env.compile = lambda *a, **kw: compiled.append(a) or compile_(*a, **kw)
+            app.precompile_templates()
+            assert compiled == []
+            @app.route('/')
+            def index():
+                return spoon.render_template('context_template.html', value=23,
+                                             injected_value=42)
+            assert app.test_client().get('/').data == '<p>23|42'
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_production_template_mode(self):
+        import shutil
+        from jinja2 import FileSystemLoader
+        template_dir = tempfile.mkdtemp()
+        path = os.path.join(template_dir, 'page.html')
+        try:
+            class App(spoon.Spoon):
+                template_cache_size = 10
+                def create_jinja_loader(self):
+                    return FileSystemLoader(template_dir)
+            app = App(__name__)
+            assert not app.jinja_env.auto_reload
+            @app.route('/')
+            def index():
+                return spoon.render_template('page.html')
+            c = app.test_client()
+            with open(path, 'w') as f:
+                f.write('v1')
+            assert c.get('/').data == 'v1'
+            with open(path, 'w') as f:
+                f.write('v2')
+            os.utime(path, (0, 0))
+            assert c.get('/').data == 'v1'
+            assert app.template_cache.stats() == dict(hits=1, misses=1,
+                                                      size=1, maxsize=10)
+            app.debug = True
+            assert app.jinja_env.auto_reload
+            assert c.get('/').data == 'v2'
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_stream_template(self):
+        app = spoon.Spoon(__name__)
+        app.secret_key = 'testkey'
+        @app.route('/show/<int:n>')
+        def show(n):
+            pass
+        @app.route('/flash')
+        def flash():
+            spoon.flash('hello')
+            return 'flashed'
+        @app.route('/')
+        def index():
+            return spoon.stream_template('stream_template.html', items=range(3))
+        @app.route('/unbuffered')
+        def unbuffered():
+            return spoon.stream_template('stream_template.html', buffer_size=1,
+                                         items=range(3))
+        expected = ('<ul>\n'
+                    '<li><a href="/show/0">x0</a>\n'
+                    '<li><a href="/show/1">x1</a>\n'
+                    '<li><a href="/show/2">x2</a>\n'
+                    '</ul>')
+        storage = spoon._request_ctx_stack._local.__storage__
+        size = len(storage)
+        c = app.test_client()
+        rv = c.get('/?prefix=x')
+        assert rv.is_streamed
+        assert rv.data == expected
+        assert c.get('/unbuffered?prefix=x').data == expected
+        assert len(storage) == size
+
+        with app.test_request_context('/?prefix=x'):
+            buffered = list(index().response)
+            unbuffered_chunks = list(unbuffered().response)
+        assert ''.join(buffered) == ''.join(unbuffered_chunks) == expected
+        assert len(buffered) < len(unbuffered_chunks)
+
+        c.get('/flash')
+        assert c.get('/?prefix=x').data == '<p>hello\n' + expected
+        assert c.get('/?prefix=x').data == expected
+
+    def test_fragment_cache(self):
+        app = spoon.Spoon(__name__)
+        @app.route('/<key>/<value>')
+        def index(key, value):
+            return spoon.render_template('fragment_template.html', key=key, value=value)
+        c = app.test_client()
+        assert c.get('/a/<1>').data == '&lt;1&gt;|&lt;1&gt;'
+        # 同一个key复用缓存的片段, ttl为0的片段每次重新渲染
+        assert c.get('/a/2').data == '&lt;1&gt;|2'
+        assert c.get('/b/3').data == '3|3'
+        stats = app.fragment_cache.stats()
+        assert (stats['hits'], stats['misses']) == (1, 5)
+
+        app.jinja_env.fragment_cache_prefix = 'v2'
+        assert c.get('/a/4').data == '4|4'
+
+        class App(spoon.Spoon):
+            fragment_cache_size = 0
+        app = App(__name__)
+        app.route('/<key>/<value>')(index)
+        c = app.test_client()
+        assert app.fragment_cache is None
+        c.get('/a/1')
+        assert c.get('/a/2').data == '2|2'
+
     def test_escaping(self):
         text = '<p>Hello World!'
         app = spoon.Spoon(__name__)